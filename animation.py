@@ -0,0 +1,108 @@
+import io
+
+import av
+from PIL import Image
+
+TRANSPARENT = 255
+
+
+def _open(source):
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    return av.open(source)
+
+
+def _scaled_size(width: int, height: int, max_dimension: int):
+    scale = min(1, max_dimension / max(width, height))
+    # even sizes keep swscale away from odd chroma edge cases
+    return max(2, round(width * scale) // 2 * 2), max(2, round(height * scale) // 2 * 2)
+
+
+def _frame_rate(stream, fps: float, max_frames: int):
+    duration = None
+    if stream.duration and stream.time_base:
+        duration = float(stream.duration * stream.time_base)
+    elif stream.container.duration:
+        duration = stream.container.duration / av.time_base
+    if duration:
+        return min(fps, max_frames / duration)
+    return fps
+
+
+def iter_frames(source, max_dimension: int = 320, fps: float = 15, max_frames: int = 100):
+    # yields (RGBA image, timestamp in seconds) one kept frame at a time
+    with _open(source) as container:
+        stream = container.streams.video[0]
+        stream.thread_type = "AUTO"
+        fps = _frame_rate(stream, fps, max_frames)
+        size = None
+        next_time = 0
+        kept = 0
+        for frame in container.decode(stream):
+            time = frame.time if frame.time is not None else kept / fps
+            # drop every frame that falls before the next slot of the target frame rate
+            if time + 1e-6 < next_time:
+                continue
+            if size is None:
+                size = _scaled_size(frame.width, frame.height, max_dimension)
+            rgba = frame.reformat(width=size[0], height=size[1], format="rgba").to_ndarray()
+            yield Image.fromarray(rgba, "RGBA"), time
+            kept += 1
+            if kept >= max_frames:
+                break
+            next_time = max(next_time + 1 / fps, time + 0.5 / fps)
+
+
+def _build_palette(samples):
+    width = max(image.width for image in samples)
+    montage = Image.new("RGB", (width, sum(image.height for image in samples)))
+    y = 0
+    for image in samples:
+        montage.paste(image.convert("RGB"), (0, y))
+        y += image.height
+    palette = montage.quantize(colors=TRANSPARENT, method=Image.Quantize.MEDIANCUT)
+    colors = palette.getpalette()[:TRANSPARENT * 3]
+    palette.putpalette(colors + [0] * (768 - len(colors)))
+    return palette
+
+
+def _quantize(image: Image.Image, palette: Image.Image):
+    frame = image.convert("RGB").quantize(palette=palette, dither=Image.Dither.FLOYDSTEINBERG)
+    alpha = image.getchannel("A")
+    if alpha.getextrema()[0] < 128:
+        frame.paste(TRANSPARENT, mask=alpha.point(lambda a: 255 if a < 128 else 0))
+    return frame
+
+
+def encode_gif(source, max_dimension: int = 320, fps: float = 15, max_frames: int = 100,
+               palette_samples: int = 8) -> bytes:
+    # only the first palette_samples frames are held as RGBA to build the shared palette,
+    # every other frame is quantized to one byte per pixel as soon as it is decoded
+    samples = []
+    frames = []
+    times = []
+    palette = None
+    for image, time in iter_frames(source, max_dimension, fps, max_frames):
+        times.append(time)
+        if palette is None:
+            samples.append(image)
+            if len(samples) < palette_samples:
+                continue
+            palette = _build_palette(samples)
+            frames.extend(_quantize(sample, palette) for sample in samples)
+            samples = []
+        else:
+            frames.append(_quantize(image, palette))
+    if samples:
+        palette = _build_palette(samples)
+        frames.extend(_quantize(sample, palette) for sample in samples)
+    if not frames:
+        raise ValueError("no frames decoded")
+
+    durations = [max(20, round((end - start) * 1000)) for start, end in zip(times, times[1:])]
+    durations.append(durations[-1] if durations else round(1000 / fps))
+
+    output = io.BytesIO()
+    frames[0].save(output, format="GIF", save_all=True, append_images=frames[1:], duration=durations,
+                   loop=0, transparency=TRANSPARENT, disposal=2, optimize=False)
+    return output.getvalue()
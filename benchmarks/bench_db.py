@@ -0,0 +1,66 @@
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import database as DB  # noqa: E402
+
+
+def fill(path: str, rows: int):
+    # start from the first, unindexed schema, like a database created before migrations existed
+    con = sqlite3.connect(path)
+    for statement in DB.MIGRATIONS[0]:
+        con.execute(statement)
+    con.execute("PRAGMA user_version = 1")
+    con.executemany("INSERT INTO message VALUES(?, ?, ?, ?, ?)",
+                    ((-(i % 200), i, 1, i % 200, i) for i in range(rows)))
+    con.executemany("INSERT INTO forum_topic VALUES(?, ?)", ((-i, i) for i in range(200)))
+    con.commit()
+    con.close()
+
+
+def lookup_latency(select, rows: int, lookups: int) -> float:
+    ids = [random.randrange(rows) for _ in range(lookups)]
+    start = time.perf_counter()
+    for i in ids:
+        select(i)
+    return (time.perf_counter() - start) / lookups
+
+
+def measure(db: DB.Database, rows: int, lookups: int):
+    qq = lookup_latency(lambda i: db.select_message_where_qq(-(i % 200), i), rows, lookups)
+    tg = lookup_latency(lambda i: db.select_message_where_tg(i % 200, i), rows, lookups)
+    topic = lookup_latency(lambda i: db.select_tg_forum_topic_id(-(i % 200)), rows, lookups)
+    return qq, tg, topic
+
+
+def main():
+    print(f"{'rows':>9} {'schema':>7} {'where_qq':>11} {'where_tg':>11} {'topic_id':>11}")
+    for rows in (10_000, 100_000, 1_000_000):
+        lookups = max(20, 2_000_000 // rows)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "bench.db")
+            fill(path, rows)
+            versions = DB.MIGRATIONS
+            # open at version 1 by hiding the later migrations, then let the real constructor migrate
+            DB.MIGRATIONS = versions[:1]
+            db = DB.Database(path)
+            DB.MIGRATIONS = versions
+            results = measure(db, rows, lookups)
+            print(f"{rows:>9} {'v1':>7} " + " ".join(f"{r * 1e6:>9.1f}us" for r in results))
+            db.close()
+            start = time.perf_counter()
+            db = DB.Database(path)
+            migrated = time.perf_counter() - start
+            results = measure(db, rows, lookups)
+            print(f"{rows:>9} {'latest':>7} " + " ".join(f"{r * 1e6:>9.1f}us" for r in results)
+                  + f"   (migration took {migrated:.2f}s)")
+            db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+import io
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import av
+import imageio.v3 as iio
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import animation  # noqa: E402
+
+
+def make_clip(container_format: str, codec: str, width: int, height: int, fps: int, seconds: float) -> bytes:
+    output = io.BytesIO()
+    with av.open(output, "w", format=container_format) as container:
+        stream = container.add_stream(codec, rate=fps)
+        stream.width = width
+        stream.height = height
+        stream.pix_fmt = "yuv420p"
+        y, x = np.mgrid[0:height, 0:width]
+        for i in range(int(fps * seconds)):
+            rgb = np.stack([(x + i * 4) % 256, (y + i * 2) % 256, (x + y + i * 8) % 256], axis=-1).astype(np.uint8)
+            for packet in stream.encode(av.VideoFrame.from_ndarray(rgb, format="rgb24")):
+                container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
+    return output.getvalue()
+
+
+def legacy_gif(data: bytes) -> bytes:
+    frames = iio.imread(data, index=None, plugin="pyav", format="rgba")
+    return iio.imwrite("<bytes>", frames, extension=".gif", duration=50, loop=0)
+
+
+def measure(fn, data):
+    tracemalloc.start()
+    start = time.perf_counter()
+    output = fn(data)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, len(output), peak
+
+
+def main():
+    clips = {
+        "sticker 512x512 30fps 3s (webm/vp9)": make_clip("webm", "libvpx-vp9", 512, 512, 30, 3),
+        "animation 640x360 30fps 5s (mp4/h264)": make_clip("mp4", "h264", 640, 360, 30, 5),
+    }
+    for name, data in clips.items():
+        print(f"{name}, {len(data)} bytes")
+        for label, fn in (("legacy imageio", legacy_gif), ("animation", animation.encode_gif)):
+            elapsed, size, peak = measure(fn, data)
+            print(f"  {label:<15} {elapsed * 1000:8.1f} ms  {size / 1024:8.1f} KiB gif  {peak / 1024 / 1024:7.1f} MiB traced peak")
+
+
+if __name__ == "__main__":
+    main()
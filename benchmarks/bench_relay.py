@@ -0,0 +1,384 @@
+import argparse
+import asyncio
+import collections
+import contextlib
+import inspect
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import shutil
+import signal
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from aiohttp import web
+from PIL import Image
+
+# end-to-end load test: a fake OneBot V11 implementation (forward websocket) and a fake Telegram Bot API
+# run in a child process, the real bot.py runs in this one against them
+
+ROOT = Path(__file__).resolve().parent.parent
+SELF_ID = 10000
+CHAT_ID = -1001000000000
+TOKEN = "1:bench"
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+MARKER = re.compile(r"\[bench:(\d+)\]")
+
+SCENARIOS = {
+    "text": {"text": 1},
+    "images": {"image": 1},
+    "stickers": {"sticker": 1},
+    "replies": {"text": 1, "reply": 1},
+    "mixed": {"text": 6, "image": 2, "reply": 1, "sticker": 1, "tg_photo": 1},
+}
+
+
+def noise_png(seed: int, size: int = 256) -> bytes:
+    output = io.BytesIO()
+    Image.frombytes("RGB", (size, size), random.Random(seed).randbytes(size * size * 3)).save(output, "PNG")
+    return output.getvalue()
+
+
+def animated_gif(seed: int, frames: int = 24, size: int = 160) -> bytes:
+    rng = random.Random(seed)
+    images = [Image.new("RGB", (size, size), tuple(rng.randrange(256) for _ in range(3))) for _ in range(frames)]
+    output = io.BytesIO()
+    images[0].save(output, "GIF", save_all=True, append_images=images[1:], duration=40, loop=0)
+    return output.getvalue()
+
+
+class FakeBackends:
+    def __init__(self, args) -> None:
+        self.args = args
+        self.groups = [100000 + i for i in range(args.chats)]
+        self.media = {f"img{i}.png": noise_png(i) for i in range(16)}
+        self.media.update({f"sticker{i}.gif": animated_gif(i) for i in range(4)})
+        self.qq_ids = itertools.count(1)
+        self.tg_ids = itertools.count(1)
+        self.thread_ids = itertools.count(2)
+        self.topics: dict[str, int] = {}
+        self.recent: dict[int, list[int]] = collections.defaultdict(list)
+        self.sent_at: dict[int, float] = {}
+        self.latency: dict[int, float] = {}
+        self.calls = collections.Counter()
+        # the adapter throws away the first batch getUpdates returns, so update 0 is a throwaway
+        self.updates = [{"update_id": 0, "message": {"message_id": 0, "date": int(time.time()), "text": "/start",
+                                                     "chat": {"id": 1, "type": "private", "first_name": "a"},
+                                                     "from": {"id": 1, "is_bot": False, "first_name": "a"}}}]
+        self.new_update = asyncio.Condition()
+        self.connected = asyncio.Event()
+        self.polling = asyncio.Event()
+        self.done = asyncio.Event()
+        self.ws: web.WebSocketResponse = None
+        self.base_url = None
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=256 * 1024 * 1024)
+        app.router.add_get("/onebot", self.onebot)
+        app.router.add_post("/bot{token}/{method}", self.telegram)
+        app.router.add_get("/file/bot{token}/media/{name}", self.download)
+        app.router.add_get("/media/{name}", self.download)
+        return app
+
+    def delay(self, mean: float) -> float:
+        return random.expovariate(1 / mean) if mean > 0 else 0
+
+    def record(self, payload: str):
+        now = time.perf_counter()
+        for seq in map(int, MARKER.findall(payload)):
+            if seq in self.sent_at and seq not in self.latency:
+                self.latency[seq] = now - self.sent_at[seq]
+        if len(self.latency) == self.args.messages:
+            self.done.set()
+
+    async def download(self, request: web.Request) -> web.Response:
+        await asyncio.sleep(self.delay(self.args.download_latency))
+        self.calls["download"] += 1
+        return web.Response(body=self.media[request.match_info["name"]])
+
+    # OneBot V11
+
+    async def onebot(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse(max_msg_size=0)
+        await ws.prepare(request)
+        self.ws = ws
+        await ws.send_json({"time": int(time.time()), "self_id": SELF_ID, "post_type": "meta_event",
+                            "meta_event_type": "lifecycle", "sub_type": "connect"})
+        self.connected.set()
+        async for msg in ws:
+            asyncio.create_task(self.onebot_call(ws, msg.data))
+        return ws
+
+    async def onebot_call(self, ws: web.WebSocketResponse, raw: str):
+        call = json.loads(raw)
+        action = call["action"]
+        params = call.get("params", {})
+        self.calls[f"qq:{action}"] += 1
+        data = None
+        match action:
+            case "get_group_list":
+                data = [{"group_id": group_id, "group_name": f"bench group {group_id}", "member_count": 10,
+                         "max_member_count": 200} for group_id in self.groups]
+            case "get_friend_list":
+                data = []
+            case "get_msg":
+                data = {"time": int(time.time()), "message_type": "group", "message_id": params["message_id"],
+                        "real_id": params["message_id"], "sender": {"user_id": 42, "nickname": "user 42"},
+                        "message": [{"type": "text", "data": {"text": "earlier"}}]}
+            case "send_msg" | "send_group_msg" | "send_private_msg":
+                await asyncio.sleep(self.delay(self.args.qq_latency))
+                self.record(raw)
+                data = {"message_id": next(self.qq_ids)}
+        if not ws.closed:
+            await ws.send_json({"status": "ok", "retcode": 0, "data": data, "echo": call.get("echo")})
+
+    def qq_event(self, group_id: int, message: list) -> dict:
+        message_id = next(self.qq_ids)
+        self.recent[group_id].append(message_id)
+        user_id = random.randrange(1000, 1100)
+        return {"time": int(time.time()), "self_id": SELF_ID, "post_type": "message", "message_type": "group",
+                "sub_type": "normal", "message_id": message_id, "group_id": group_id, "user_id": user_id,
+                "anonymous": None, "message": message, "raw_message": "", "font": 0,
+                "sender": {"user_id": user_id, "nickname": f"user {user_id}", "card": ""}}
+
+    # Telegram Bot API
+
+    def tg_message(self, thread_id: int, extra: dict = None) -> dict:
+        return {"message_id": next(self.tg_ids), "date": int(time.time()), "from": BOT_USER,
+                "chat": {"id": CHAT_ID, "type": "supergroup", "title": "bench", "is_forum": True},
+                "message_thread_id": thread_id, "is_topic_message": True, **(extra or {})}
+
+    def tg_media(self, kind: str) -> dict:
+        file_id = f"sent{next(self.tg_ids)}"
+        if kind == "photo":
+            return {"photo": [{"file_id": file_id, "file_unique_id": file_id, "width": 256, "height": 256}]}
+        return {kind: {"file_id": file_id, "file_unique_id": file_id, "width": 256, "height": 256, "duration": 1}}
+
+    async def telegram(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        if request.content_type.startswith("multipart/"):
+            form = await request.post()
+            params = {key: value for key, value in form.items() if isinstance(value, str)}
+        else:
+            params = await request.json() if request.can_read_body else {}
+        self.calls[f"tg:{method}"] += 1
+        if method == "getUpdates":
+            return self.ok(await self.get_updates(params))
+        if method.startswith("send") or method == "createForumTopic":
+            await asyncio.sleep(self.delay(self.args.tg_latency))
+        if method.startswith("send") and random.random() < self.args.tg_429_rate:
+            self.calls["tg:429"] += 1
+            return web.json_response({"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                                      "parameters": {"retry_after": 1}}, status=429)
+        thread_id = int(params.get("message_thread_id") or 0)
+        match method:
+            case "getMe":
+                return self.ok(BOT_USER)
+            case "deleteWebhook":
+                return self.ok(True)
+            case "createForumTopic":
+                thread_id = next(self.thread_ids)
+                self.topics[params["name"]] = thread_id
+                return self.ok({"message_thread_id": thread_id, "name": params["name"], "icon_color": 7322096})
+            case "getFile":
+                name = params["file_id"]
+                return self.ok({"file_id": name, "file_unique_id": name, "file_size": len(self.media[name]),
+                                "file_path": f"media/{name}"})
+            case "sendMessage":
+                self.record(json.dumps(params))
+                return self.ok(self.tg_message(thread_id))
+            case "sendMediaGroup":
+                self.record(json.dumps(params))
+                media = params["media"] if isinstance(params["media"], list) else json.loads(params["media"])
+                return self.ok([self.tg_message(thread_id, self.tg_media(item["type"])) for item in media])
+            case _ if method.startswith("send"):
+                self.record(json.dumps(params))
+                return self.ok(self.tg_message(thread_id, self.tg_media(method[4:].lower())))
+        return self.ok(True)
+
+    def ok(self, result) -> web.Response:
+        return web.json_response({"ok": True, "result": result})
+
+    async def get_updates(self, params: dict) -> list:
+        self.polling.set()
+        if params.get("offset") is None:
+            return self.updates[:1]
+        offset = int(params["offset"])
+        async with self.new_update:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self.new_update.wait_for(lambda: len(self.updates) > offset), 1)
+        return self.updates[offset:]
+
+    async def push_update(self, message: dict):
+        async with self.new_update:
+            self.updates.append({"update_id": len(self.updates), "message": message})
+            self.new_update.notify_all()
+
+    def tg_event(self, thread_id: int, extra: dict) -> dict:
+        user = {"id": 2000 + random.randrange(100), "is_bot": False, "first_name": "tg user"}
+        return {"message_id": next(self.tg_ids), "date": int(time.time()), "from": user,
+                "chat": {"id": CHAT_ID, "type": "supergroup", "title": "bench", "is_forum": True},
+                "message_thread_id": thread_id, "is_topic_message": True, **extra}
+
+    # driving the load
+
+    async def inject(self, seq: int, kind: str):
+        marker = f"[bench:{seq}]"
+        group_id = random.choice(self.groups)
+        thread_id = self.topics[f"bench group {group_id}"]
+        self.sent_at[seq] = time.perf_counter()
+        match kind:
+            case "text":
+                await self.ws.send_json(self.qq_event(group_id, [{"type": "text", "data": {"text": f"hello {marker}"}}]))
+            case "image":
+                images = random.sample(sorted(name for name in self.media if name.endswith(".png")), random.randint(1, 4))
+                message = [{"type": "image", "data": {"file": name, "url": f"{self.base_url}/media/{name}"}} for name in images]
+                await self.ws.send_json(self.qq_event(group_id, message + [{"type": "text", "data": {"text": marker}}]))
+            case "reply":
+                reply_to = random.choice(self.recent[group_id])
+                message = [{"type": "reply", "data": {"id": str(reply_to)}}, {"type": "text", "data": {"text": f"re {marker}"}}]
+                await self.ws.send_json(self.qq_event(group_id, message))
+            case "sticker":
+                name = f"sticker{random.randrange(4)}.gif"
+                animation = {"file_id": name, "file_unique_id": name, "width": 160, "height": 160, "duration": 1}
+                await self.push_update(self.tg_event(thread_id, {"caption": marker, "animation": animation,
+                                                                 "document": animation}))
+            case "tg_photo":
+                name = f"img{random.randrange(16)}.png"
+                photo = [{"file_id": name, "file_unique_id": name, "width": 256, "height": 256}]
+                await self.push_update(self.tg_event(thread_id, {"caption": marker, "photo": photo}))
+
+    async def drive(self) -> dict:
+        await self.connected.wait()
+        await self.polling.wait()
+        # warm up: the first message of every group creates its forum topic, which isn't what we measure
+        for group_id in self.groups:
+            await self.ws.send_json(self.qq_event(group_id, [{"type": "text", "data": {"text": "warm up"}}]))
+        while len(self.topics) < len(self.groups):
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(1)
+        self.calls.clear()
+
+        kinds, weights = zip(*SCENARIOS[self.args.scenario].items())
+        start = time.perf_counter()
+        for seq in range(self.args.messages):
+            await self.inject(seq, random.choices(kinds, weights)[0])
+            if self.args.rate:
+                await asyncio.sleep(max(0, start + (seq + 1) / self.args.rate - time.perf_counter()))
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self.done.wait(), self.args.timeout)
+        elapsed = max((self.sent_at[seq] + latency for seq, latency in self.latency.items()), default=start) - start
+        return {"received": len(self.latency), "elapsed": elapsed, "latencies": sorted(self.latency.values()),
+                "calls": dict(self.calls)}
+
+
+def run_fakes(args, conn):
+    async def main():
+        fakes = FakeBackends(args)
+        runner = web.AppRunner(fakes.app(), access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        fakes.base_url = f"http://127.0.0.1:{port}"
+        conn.send(port)
+        results = await fakes.drive()
+        conn.send(results)
+        os.kill(os.getppid(), signal.SIGINT)
+        await asyncio.sleep(5)
+        await runner.cleanup()
+
+    asyncio.run(main())
+
+
+def percentile(values: list, q: float) -> float:
+    return values[min(len(values) - 1, int(q * len(values)))] if values else float("nan")
+
+
+def sample_workers(transcoder, peaks: dict, stop: threading.Event):
+    # the transcoding pool's processes are invisible to RUSAGE_SELF, VmHWM is each one's own peak RSS
+    while not stop.wait(0.2):
+        executor = transcoder.executor
+        for pid in list(executor and executor._processes or ()):
+            with contextlib.suppress(OSError, TypeError):
+                status = Path(f"/proc/{pid}/status").read_text()
+                peaks[pid] = int(re.search(r"VmHWM:\s+(\d+)", status)[1])
+
+
+def report(args, results: dict, worker_peaks: dict):
+    latencies = results["latencies"]
+    print(f"scenario {args.scenario}: {results['received']}/{args.messages} messages relayed "
+          f"across {args.chats} chats in {results['elapsed']:.2f}s")
+    print(f"throughput {results['received'] / max(results['elapsed'], 1e-9):.1f} msgs/s, "
+          f"latency p50 {percentile(latencies, 0.5) * 1000:.0f}ms p99 {percentile(latencies, 0.99) * 1000:.0f}ms "
+          f"max {max(latencies, default=0) * 1000:.0f}ms mean {statistics.fmean(latencies) * 1000 if latencies else 0:.0f}ms")
+    print(f"peak RSS of the relay process {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MiB")
+    if worker_peaks:
+        print(f"peak RSS of the transcoding workers up to {max(worker_peaks.values()) / 1024:.0f} MiB per worker, "
+              f"{sum(worker_peaks.values()) / 1024:.0f} MiB across all {len(worker_peaks)}")
+    print("backend calls: " + ", ".join(f"{key}={value}" for key, value in sorted(results["calls"].items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="replay an event mix through bot.py against fake QQ and Telegram backends")
+    parser.add_argument("scenario", nargs="?", default="mixed", choices=SCENARIOS)
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--rate", type=float, default=0, help="messages per second to inject, 0 injects them all at once")
+    parser.add_argument("--tg-latency", type=float, default=0.05, help="mean Telegram API latency in seconds")
+    parser.add_argument("--tg-429-rate", type=float, default=0.01, help="share of Telegram sends answered with 429")
+    parser.add_argument("--qq-latency", type=float, default=0.03, help="mean OneBot send latency in seconds")
+    parser.add_argument("--download-latency", type=float, default=0.02, help="mean media download latency in seconds")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--real-limits", action="store_true", help="keep the scheduler's Telegram rate limits")
+    args = parser.parse_args()
+
+    import nonebot.adapters.telegram.adapter as tg_adapter
+    if "raw_update" not in inspect.getsource(tg_adapter):
+        sys.exit("the Telegram adapter isn't patched, run patch.py against the installed adapter first")
+
+    conn, child_conn = multiprocessing.Pipe()
+    fakes = multiprocessing.Process(target=run_fakes, args=(args, child_conn), daemon=True)
+    fakes.start()
+    port = conn.recv()
+
+    # bot.py reads .env and pyproject.toml from, and keeps its database and media cache in, the working directory
+    workdir = tempfile.mkdtemp(prefix="nb2tg-bench-")
+    shutil.copy(ROOT / "pyproject.toml", workdir)
+    Path(workdir, ".env").write_text(
+        "DRIVER=~aiohttp\n"
+        "LOG_LEVEL=WARNING\n"
+        f'ONEBOT_WS_URLS=["ws://127.0.0.1:{port}/onebot"]\n'
+        f'TELEGRAM_BOTS=[{{"token": "{TOKEN}", "api_server": "http://127.0.0.1:{port}/"}}]\n'
+        f"CHAT_ID={CHAT_ID}\n"
+        # every topic shares one chat, so Telegram's real limits would cap the relay far below what it can do
+        + ("" if args.real_limits else "TG_BOT_RATE=1000\nTG_CHAT_RATE=1000\nTG_CHAT_BURST=1000\n")
+    )
+    os.chdir(workdir)
+    sys.path.insert(0, str(ROOT))
+    worker_peaks = {}
+    stop_sampling = threading.Event()
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            import bot
+            threading.Thread(target=sample_workers, args=(bot.transcoder, worker_peaks, stop_sampling), daemon=True).start()
+            bot.nonebot.run()
+        stop_sampling.set()
+        if conn.poll(10):
+            report(args, conn.recv(), worker_peaks)
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import random
+import sys
+import time
+from pathlib import Path
+
+import nonebot.adapters.onebot.v11 as v11
+import nonebot.adapters.telegram as tg
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import segments  # noqa: E402
+
+SEGMENTS = 2000
+ROUNDS = 200
+
+# the old 256-entry table, "Empty" placeholders included
+LEGACY_FACES = {id: segments.QQ_FACE_NAMES.get(id, "Empty") for id in range(256)}
+
+
+def legacy_qq(message: v11.Message) -> str:
+    text = ""
+    for seg in message:
+        match seg.type:
+            case "text":
+                text += seg.data['text']
+            case "at":
+                text += f"@{seg.data['qq']} "
+            case "face":
+                if int(seg.data['id']) in LEGACY_FACES:
+                    text += f"[{LEGACY_FACES[int(seg.data['id'])]}]"
+                else:
+                    text += f"[face:{seg.data['id']}]"
+    return text
+
+
+def table_qq(converters: segments.Converters):
+    def convert(message: v11.Message) -> str:
+        parts, _ = converters.split(message)
+        return "".join(parts)
+    return convert
+
+
+def legacy_tg(message: tg.Message) -> v11.Message:
+    converted_message = ""
+    for seg in message:
+        if seg.is_text():
+            converted_message += seg.data.get("text", "")
+        else:
+            converted_message += v11.MessageSegment.image(seg.data["file"])
+    return converted_message
+
+
+def table_tg(converters: segments.Converters):
+    def convert(message: tg.Message) -> v11.Message:
+        parts, pending = converters.split(message)
+        # stands in for the relay's media converters, which would fetch the file
+        for index, seg, _ in pending:
+            parts[index] = v11.MessageSegment.image(seg.data["file"])
+        builder = segments.MessageBuilder()
+        for part in parts:
+            if isinstance(part, str):
+                builder.append_text(part)
+            else:
+                builder.append(part)
+        return builder.build()
+    return convert
+
+
+def make_qq(rng: random.Random) -> v11.Message:
+    faces = list(segments.QQ_FACE_NAMES) + [128516, 128077, 10068]
+    message = []
+    for _ in range(SEGMENTS):
+        kind = rng.random()
+        if kind < 0.6:
+            message.append(v11.MessageSegment.face(rng.choice(faces)))
+        elif kind < 0.9:
+            message.append(v11.MessageSegment.text(rng.choice(["哈", "ok ", "今天", "!!"]) * rng.randint(1, 4)))
+        else:
+            message.append(v11.MessageSegment.at(rng.randint(10000, 99999)))
+    return v11.Message(message)
+
+
+def make_tg(rng: random.Random) -> tg.Message:
+    # a long formatted Telegram message splits into one segment per entity, an album adds a few photos
+    entities = (tg.message.Entity.text, tg.message.Entity.bold, tg.message.Entity.italic, tg.message.Entity.code)
+    message = []
+    for i in range(SEGMENTS):
+        if i % 200 == 100:
+            message.append(tg.message.File.photo(f"file-{i}"))
+        else:
+            message.append(rng.choice(entities)(rng.choice(["😀", "word ", "👍👍", "链接"])))
+    return tg.Message(message)
+
+
+def measure(fn, message) -> tuple[float, object]:
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        output = fn(message)
+    return (time.perf_counter() - start) / ROUNDS, output
+
+
+def main():
+    rng = random.Random(0)
+    qq_message = make_qq(rng)
+    tg_message = make_tg(rng)
+    print(f"QQ -> Telegram, {SEGMENTS} segments, 60% faces")
+    for label, fn in (("legacy +=", legacy_qq), ("table, text", table_qq(segments.qq_converters(False))),
+                      ("table, emoji", table_qq(segments.qq_converters(True)))):
+        elapsed, output = measure(fn, qq_message)
+        print(f"  {label:<13} {elapsed * 1000:8.2f} ms  {len(output)} chars")
+    converters = segments.tg_converters()
+    converters.register_media("photo")(lambda *args: None)
+    print(f"Telegram -> QQ, {SEGMENTS} segments, mostly text entities")
+    for label, fn in (("legacy +=", legacy_tg), ("builder", table_tg(converters))):
+        elapsed, output = measure(fn, tg_message)
+        print(f"  {label:<13} {elapsed * 1000:8.2f} ms  {len(output)} segments")
+
+
+if __name__ == "__main__":
+    main()
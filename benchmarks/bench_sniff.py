@@ -0,0 +1,36 @@
+import sys
+import time
+from pathlib import Path
+
+import imageio.v3 as iio
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from sniff import SNIFF_SIZE, sniff  # noqa: E402
+from transcode import probe_codec  # noqa: E402
+
+ROUNDS = 50
+
+
+def measure(fn, data) -> tuple[float, object]:
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        result = fn(data)
+    return (time.perf_counter() - start) / ROUNDS, result
+
+
+def main():
+    # what QQ images usually are, at a typical phone photo size
+    y, x = np.mgrid[0:1280, 0:960]
+    image = np.stack([x % 256, y % 256, (x + y) % 256], axis=-1).astype(np.uint8)
+    samples = {extension: iio.imwrite("<bytes>", image, extension=extension) for extension in (".jpg", ".png", ".gif", ".webp")}
+    for extension, data in samples.items():
+        print(f"{extension[1:]}, {len(data) / 1024:.0f} KiB")
+        elapsed, codec = measure(probe_codec, data)
+        print(f"  {'pyav probe':<12} {elapsed * 1e6:10.1f} us  {codec}")
+        elapsed, info = measure(lambda data: sniff(data[:SNIFF_SIZE]), data)
+        print(f"  {'sniff':<12} {elapsed * 1e6:10.1f} us  {info.format} {info.width}x{info.height}")
+
+
+if __name__ == "__main__":
+    main()
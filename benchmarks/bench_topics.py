@@ -0,0 +1,84 @@
+import asyncio
+import contextlib
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+ROOT = Path(__file__).resolve().parent.parent
+CHAT_ID = -1001000000000
+CHATS = 500
+MESSAGES_PER_CHAT = 5
+CREATE_LATENCY = 0.2
+
+
+class FakeTelegram:
+    # stands in for telegram_master(), a slow createForumTopic that hands out thread ids
+    def __init__(self) -> None:
+        self.thread_ids = itertools.count(2)
+        self.created: list[str] = []
+
+    async def create_forum_topic(self, chat_id: int, name: str):
+        assert chat_id == CHAT_ID
+        await asyncio.sleep(CREATE_LATENCY)
+        self.created.append(name)
+        return SimpleNamespace(message_thread_id=next(self.thread_ids))
+
+
+async def run(get_topic, chats) -> float:
+    start = time.perf_counter()
+    await asyncio.gather(*(get_topic(-chat, str(chat)) for chat in chats for _ in range(MESSAGES_PER_CHAT)))
+    return time.perf_counter() - start
+
+
+def check(bot, fake: FakeTelegram, chats):
+    assert sorted(fake.created) == sorted(str(chat) for chat in chats), "a chat got more or less than one topic"
+    topics = {bot.db.select_tg_forum_topic_id(qq_unique_id=-chat) for chat in chats}
+    assert None not in topics and len(topics) == len(chats), "a created topic wasn't recorded"
+
+
+async def main(bot):
+    # many brand new chats at once through the real get_forum_topic
+    fake = FakeTelegram()
+    bot.telegram_master = lambda: fake
+    chats = range(CHATS)
+    elapsed = await run(bot.get_forum_topic, chats)
+    check(bot, fake, chats)
+    assert not len(bot.forum_topic_flights), "finished flights must be forgotten"
+    print(f"single flight: {CHATS} new chats x {MESSAGES_PER_CHAT} messages in {elapsed:.2f}s, "
+          f"{len(fake.created)} topics created")
+
+    # the old behaviour, one lock around every creation, left to create_forum_topic's re-check to dedupe
+    fake.created.clear()
+    lock = asyncio.Lock()
+
+    async def global_lock(unique_id, name):
+        async with lock:
+            return await bot.create_forum_topic(unique_id, name)
+
+    # it serializes every creation, so only time a slice of it on chats the first run didn't see
+    sample = range(CHATS, CHATS + CHATS // 50)
+    elapsed = await run(global_lock, sample) * CHATS / len(sample)
+    check(bot, fake, sample)
+    print(f"global lock:   {CHATS} new chats x {MESSAGES_PER_CHAT} messages in ~{elapsed:.2f}s (extrapolated)")
+
+
+if __name__ == "__main__":
+    # bot.py reads .env and pyproject.toml from, and keeps its database and media cache in, the working directory
+    workdir = tempfile.mkdtemp(prefix="nb2tg-bench-")
+    shutil.copy(ROOT / "pyproject.toml", workdir)
+    Path(workdir, ".env").write_text(f"DRIVER=~aiohttp\nLOG_LEVEL=WARNING\nCHAT_ID={CHAT_ID}\n")
+    os.chdir(workdir)
+    sys.path.insert(0, str(ROOT))
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            import bot
+        asyncio.run(main(bot))
+        bot.db.close()
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
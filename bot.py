@@ -1,9 +1,14 @@
 import asyncio
+import contextlib
+import contextvars
+import functools
+import importlib.util
+import itertools
+from dataclasses import dataclass, field
 import json
-from pathlib import Path
+from pathlib import Path, PurePosixPath
 import time
 import traceback
-import imageio.v3 as iio
 import nonebot
 from nonebot import on, on_command, logger
 from nonebot.rule import is_type
@@ -11,7 +16,23 @@ from nonebot.params import CommandArg
 import nonebot.adapters.onebot.v11 as v11
 import nonebot.adapters.telegram as tg
 import database as DB
-from utils import qq_emoji_text_list, download_file
+import metrics
+import segments
+from media_cache import MediaCache
+from metrics import stage_seconds
+from outbox import Outbox
+from directory import Directory
+from dispatch import Dispatcher, Retry
+from scheduler import TelegramScheduler
+from sniff import SNIFF_SIZE, MediaInfo, sniff
+from transcode import Transcoder, probe_codec, to_gif, to_ogg_opus, to_qq_voice
+from utils import download_to_file, open_local_file, file_sha256, upload_view, open_http_client, close_http_client, process_uptime, utf16_len, SingleFlight, BotUnavailable
+
+ALBUM_LIMIT = 10
+CAPTION_LIMIT = 1024
+MESSAGE_LIMIT = 4096
+PHOTO_MAX_DIMENSIONS = 10000
+PHOTO_MAX_RATIO = 20
 
 nonebot.init()
 driver = nonebot.get_driver()
@@ -19,15 +40,107 @@ driver.register_adapter(v11.Adapter)
 driver.register_adapter(tg.Adapter)
 nonebot.load_from_toml("pyproject.toml")
 
-db = DB.Database("nb2tg.db")
-forum_topic_lock = asyncio.Lock()
-group_list_lock = asyncio.Lock()
-_group_list = {}
-tg_bots_last_message_timestamp = {}
+db = DB.Database("nb2tg.db",
+                 write_behind=getattr(driver.config, "db_write_behind", True),
+                 batch_size=getattr(driver.config, "db_batch_size", 100),
+                 flush_interval=getattr(driver.config, "db_flush_interval", 0.5),
+                 message_cache_size=getattr(driver.config, "db_message_cache_size", 65536))
+forum_topic_flights = SingleFlight()
+pending_albums: dict[str, tuple[float, list]] = {}
+open_batches: dict[int, "CoalescedBatch"] = {}
+media_spool_threshold = getattr(driver.config, "media_spool_threshold", 4 * 1024 * 1024)
+media_max_size = getattr(driver.config, "media_max_size", 50 * 1024 * 1024)
+media_cache = MediaCache(getattr(driver.config, "media_cache_dir", "media_cache"),
+                         max_size=getattr(driver.config, "media_cache_size", 512 * 1024 * 1024),
+                         memory_size=getattr(driver.config, "media_cache_memory_size", 32 * 1024 * 1024))
+transcoder = Transcoder(workers=getattr(driver.config, "transcode_workers", 2),
+                        queue_size=getattr(driver.config, "transcode_queue_size", 16),
+                        timeout=getattr(driver.config, "transcode_timeout", 60))
+gif_max_dimension = getattr(driver.config, "gif_max_dimension", 320)
+gif_fps = getattr(driver.config, "gif_fps", 15)
+gif_max_frames = getattr(driver.config, "gif_max_frames", 100)
+# voice notes become OGG/Opus for Telegram and SILK (AMR without pysilk) for QQ
+voice_transcode = getattr(driver.config, "voice_transcode", True)
+qq_voice_format = getattr(driver.config, "qq_voice_format", "silk" if importlib.util.find_spec("pysilk") else "amr")
+# per segment type, how Telegram media above media_inline_max_size reach the OneBot implementation:
+# "url" lets it fetch from Telegram, "path" hands it our cached copy, "bytes" sends the file inline
+media_transfer = getattr(driver.config, "media_transfer", {"video": "url"})
+media_inline_max_size = getattr(driver.config, "media_inline_max_size", 1024 * 1024)
+media_cache_remote_dir = getattr(driver.config, "media_cache_remote_dir", None)
+media_fetch_concurrency = getattr(driver.config, "media_fetch_concurrency", 4)
+album_gather_window = getattr(driver.config, "album_gather_window", 1.0)
+coalesce_qq_ids = set(getattr(driver.config, "coalesce_qq_ids", []))
+coalesce_window = getattr(driver.config, "coalesce_window", 2.0)
+coalesce_max_chars = getattr(driver.config, "coalesce_max_chars", 3000)
+tg_scheduler = TelegramScheduler(lambda: telegram_bots(),
+                                 bot_rate=getattr(driver.config, "tg_bot_rate", 30),
+                                 chat_rate=getattr(driver.config, "tg_chat_rate", 20 / 60),
+                                 chat_burst=getattr(driver.config, "tg_chat_burst", 20))
+directory = Directory(lambda: v11_bot().call_api("get_group_list"),
+                      lambda: v11_bot().call_api("get_friend_list"),
+                      ttl=getattr(driver.config, "directory_ttl", 600))
+dispatcher = Dispatcher(workers=getattr(driver.config, "relay_workers", 16))
+metrics_server = metrics.MetricsServer(driver,
+                                       host=getattr(driver.config, "metrics_host", "127.0.0.1"),
+                                       port=getattr(driver.config, "metrics_port", None))
+metrics_server.setup()
+outbox = Outbox(attempts=getattr(driver.config, "outbox_attempts", 10),
+                base_delay=getattr(driver.config, "outbox_base_delay", 1),
+                max_delay=getattr(driver.config, "outbox_max_delay", 300),
+                max_in_flight=getattr(driver.config, "outbox_max_in_flight", 8))
+metrics.registry.stats("nb2tg_dispatcher", dispatcher.stats)
+metrics.registry.stats("nb2tg_telegram_bot", tg_scheduler.stats, label="bot")
+metrics.registry.stats("nb2tg_media_cache", media_cache.stats)
+metrics.registry.stats("nb2tg_outbox", lambda: {**outbox.stats(), "pending": len(db.select_outbox_jobs())})
+metrics.registry.stats("nb2tg_backlog", lambda: {"transcode": transcoder.pending, "db_write": db.pending()})
+# seconds from process start to each milestone, first_relay being what a restart costs the chats
+startup_seconds: dict[str, float] = {}
+metrics.registry.stats("nb2tg_startup", lambda: {"seconds": startup_seconds}, label="phase")
+
+
+@driver.on_startup
+async def startup():
+    config = driver.config
+    await open_http_client(limit=getattr(config, "http_limit", 100),
+                           limit_per_host=getattr(config, "http_limit_per_host", 8),
+                           keepalive_timeout=getattr(config, "http_keepalive_timeout", 30),
+                           dns_cache_ttl=getattr(config, "http_dns_cache_ttl", 300),
+                           timeout=getattr(config, "http_timeout", 300),
+                           connect_timeout=getattr(config, "http_connect_timeout", 10))
+    transcoder.start()
+    asyncio.ensure_future(transcoder.warm_up())
+    dispatcher.start()
+    directory.start()
+    await metrics_server.start()
+    replay_outbox()
+    startup_seconds["ready"] = process_uptime()
+    logger.info(f"ready {startup_seconds['ready']:.2f}s after start")
+
+
+@driver.on_bot_connect
+async def bot_connect(bot: nonebot.adapters.Bot):
+    # forum topics are already in memory with the database, the chat lists need the OneBot connection
+    if isinstance(bot, v11.Bot):
+        startup_seconds.setdefault("onebot_connected", process_uptime())
+        directory.prefetch()
+    elif isinstance(bot, tg.Bot):
+        startup_seconds.setdefault("telegram_connected", process_uptime())
+
+
+@driver.on_shutdown
+async def shutdown():
+    await dispatcher.stop()
+    await directory.stop()
+    await metrics_server.stop()
+    await close_http_client()
+    transcoder.shutdown()
+    db.close()
 
 
 def telegram_master():
-    b: tg.Bot = next(bot for bot in nonebot.get_bots().values() if bot.type == "Telegram")
+    b: tg.Bot = next((bot for bot in nonebot.get_bots().values() if bot.type == "Telegram"), None)
+    if b is None:
+        raise BotUnavailable("telegram bot is not connected")
     return b
 
 
@@ -36,111 +149,226 @@ def is_telegram_master(bot: tg.Bot):
 
 
 def v11_bot() -> v11.Bot:
-    return next(bot for bot in nonebot.get_bots().values() if bot.type == "OneBot V11")
+    b = next((bot for bot in nonebot.get_bots().values() if bot.type == "OneBot V11"), None)
+    if b is None:
+        raise BotUnavailable("OneBot V11 bot is not connected")
+    return b
 
 
-def telegram_load_balance(force_bot_id: int = None):
-    if force_bot_id:
-        return nonebot.get_bot(str(force_bot_id))
+def telegram_bots() -> list[tg.Bot]:
+    return [bot for bot in nonebot.get_bots().values() if bot.type == "Telegram"]
 
-    b: tg.Bot = sorted(filter(lambda bot: bot.type == "Telegram", nonebot.get_bots().values()), 
-                       key=lambda bot: tg_bots_last_message_timestamp.get(bot.self_id, 0))[0]
-    tg_bots_last_message_timestamp[b.self_id] = time.time()
-    return b
+
+async def create_forum_topic(unique_id: int, name: str):
+    # a flight for this id may have finished between our lookup and this call
+    if forum_topic_id := db.select_tg_forum_topic_id(qq_unique_id=unique_id):
+        return forum_topic_id
+    logger.info(f"creating forum topic for {unique_id} {name}")
+    forum_topic = await telegram_master().create_forum_topic(driver.config.chat_id, name)
+    forum_topic_id = forum_topic.message_thread_id
+    logger.info(f"forum topic {forum_topic_id} created")
+    db.insert_forum_topic(DB.ForumTopic(forum_topic_id, unique_id))
+    return forum_topic_id
 
 
 async def get_forum_topic(unique_id: int, name: str):
-    async with forum_topic_lock:
-        forum_topic_id = db.select_tg_forum_topic_id(qq_unique_id=unique_id)
-        if not forum_topic_id:
-            logger.info(f"creating forum topic for {unique_id} {name}")
-            forum_topic = await telegram_master().create_forum_topic(driver.config.chat_id, name)
-            forum_topic_id = forum_topic.message_thread_id
-            logger.info(f"forum topic {forum_topic_id} created")
-            db.insert_forum_topic(DB.ForumTopic(forum_topic_id, unique_id))
+    # existing topics are served from the in-memory mapping, new ones are created once per id
+    if forum_topic_id := db.select_tg_forum_topic_id(qq_unique_id=unique_id):
         return forum_topic_id
+    return await forum_topic_flights.do(unique_id, create_forum_topic, unique_id, name)
+
+
+async def get_group_info(group_id: int):
+    group = await directory.groups.get(group_id)
+    if group is None:
+        raise KeyError(group_id)
+    return group
+
+
+def sent_file_id(tg_message, file_type: str):
+    sent = getattr(tg_message, file_type, None)
+    if isinstance(sent, list):
+        sent = sent[-1]
+    return sent.file_id if sent else None
+
+
+@dataclass
+class ConvertedSegment:
+    text: str = ""
+    entity: tg.message.File = None
+    digest: str = None
+
+
+qq_converters = segments.qq_converters(getattr(driver.config, "qq_face_emoji", True))
+tg_converters = segments.tg_converters()
 
 
-async def get_group_info(bot: v11.Bot, group_id: int):
-    async with group_list_lock:
-        if group_id not in _group_list:
-            group_list = await bot.call_api("get_group_list")
-            for group in group_list:
-                _group_list[group['group_id']] = group
-        return _group_list[group_id]
+def photo_fits(info: MediaInfo) -> bool:
+    # Telegram refuses photos outside these, they go as documents
+    if not info.width or not info.height:
+        return True
+    return (info.width + info.height <= PHOTO_MAX_DIMENSIONS
+            and max(info.width, info.height) <= PHOTO_MAX_RATIO * min(info.width, info.height))
 
 
-async def convert_message(message: v11.Message):
-    entities = ""
-    text = ""
-    for seg in message:
+@qq_converters.register_media("image")
+async def convert_image(seg: v11.MessageSegment, out: ConvertedSegment, files: contextlib.ExitStack):
+    out.text += "[image]"
+    key = f"qq:{seg.data.get('file') or seg.data['url']}"
+    if digest := media_cache.resolve(key):
+        data = files.enter_context(media_cache.open(digest))
+    else:
+        with stage_seconds.time(stage="download"):
+            data = files.enter_context(await download_to_file(seg.data['url'], media_max_size, media_spool_threshold))
+        # ret = await v11_bot().call_api("get_image", file=seg.data['file'])
+        # print(ret)
+        # data = Path(ret['file']).read_bytes()
+        digest = await media_cache.put(data, key) if data.seek(0, 2) else None
+    if not digest:
+        out.text += f"[error: failed to download image {seg.data['url']} ]"
+        logger.error(f"failed to download image {seg.data['url']}")
+        return
+    info = media_cache.meta.get(digest)
+    if info is None:
+        info = sniff(data.read(SNIFF_SIZE))
+        data.seek(0)
+        if info is None:
+            # not a container we know, let FFmpeg have a look
+            with stage_seconds.time(stage="transcode"):
+                info = MediaInfo(await transcoder.run(probe_codec, transcoder_source(digest)))
+        media_cache.meta.put(digest, info)
+    # the adapter keys uploads by name, so every image of an album needs its own
+    name = f"{digest}.{info.extension}"
+    if info.format == "gif" or not photo_fits(info):
+        out.entity = tg.message.File.document((name, data))
+    else:
+        out.entity = tg.message.File.photo((name, data))
+    out.digest = digest
+
+
+@qq_converters.register_media("record")
+async def convert_record(seg: v11.MessageSegment, out: ConvertedSegment, files: contextlib.ExitStack):
+    out.text += "[record]"
+    # data = await download_file(seg.data['url'])
+    # ret = await v11_bot().call_api("get_record", file=seg.data['file'])
+    # print(ret)
+    # data = Path(ret['file']).read_bytes()
+    data = files.enter_context(await open_local_file(seg.data['path'], media_max_size))
+    out.digest = await file_sha256(data)
+    if not voice_transcode:
+        out.entity = tg.message.File.voice((Path(seg.data['path']).name, data))
+        return
+    key = f"voice:ogg:{out.digest}"
+    if not (digest := media_cache.resolve(key)):
         try:
-            match seg.type:
-                case "text":
-                    text += seg.data['text']
-                case "at":
-                    text += f"@{seg.data['qq']} "
-                case "face":
-                    if int(seg.data['id']) in qq_emoji_text_list:
-                        text += f"[{qq_emoji_text_list[int(seg.data['id'])]}]"
-                    else:
-                        text += f"[face:{seg.data['id']}]"
-                case "mface":
-                    text += f"[mface]"
-                case "image":
-                    text += "[image]"
-                    data = await download_file(seg.data['url'])
-                    # ret = await v11_bot().call_api("get_image", file=seg.data['file'])
-                    # print(ret)
-                    # data = Path(ret['file']).read_bytes()
-                    if not data:
-                        text += f"[error: failed to download image {seg.data['url']} ]"
-                        logger.error(f"failed to download image {seg.data['url']}")
-                    else:
-                        meta = iio.immeta(data, plugin="pyav")
-                        if meta['codec'] == "gif":
-                            entities += tg.message.File.document(("image.gif", data))
-                        else:
-                            entities += tg.message.File.photo(data)
-                case "record":
-                    text += "[record]"
-                    # data = await download_file(seg.data['url'])
-                    # ret = await v11_bot().call_api("get_record", file=seg.data['file'])
-                    # print(ret)
-                    # data = Path(ret['file']).read_bytes()
-                    data = Path(seg.data['path']).read_bytes()
-                    entities += tg.message.File.voice(data)
-                case "video":
-                    text += "[video]"
-                    # data = await download_file(seg.data['url'])
-                    # ret = await v11_bot().call_api("get_file", file=seg.data['file_id'])
-                    # print(ret)
-                    data = Path(seg.data['path']).read_bytes()
-                    entities += tg.message.File.video(data)
-                case "file":
-                    text += "[file]"
-                    # data = await download_file(seg.data['url'])
-                    ret = await v11_bot().call_api("get_file", file=seg.data['file_id'])
-                    print(ret)
-                    data = Path(ret['file']).read_bytes()
-                    entities += tg.message.File.document((seg.data['file'], data))
-                case "json":
-                    data = json.loads(seg.data['data'])
-                    match data['app']:
-                        case "com.tencent.miniapp_01":
-                            text += f"[miniapp]{data['meta']['detail_1']['qqdocurl']}"
-                        # case "com.tencent.structmsg":
-                        #     text += f"[structmsg]{data['meta']['news']['jumpUrl']}"
-                        case _:
-                            logger.warning(f"unsupported json app {repr(data)}")
-                            text += f"[json]\n{json.dumps(data, ensure_ascii=False, indent=2)}"
-                case _:
-                    text += f"[{seg.type}]"
-                    logger.warning(f"unsupported message segment {repr(seg)}")
+            # the worker reads the recording from its path itself
+            with stage_seconds.time(stage="transcode"):
+                ogg = await transcoder.run(to_ogg_opus, seg.data['path'])
         except Exception as e:
-            text += f"\n[ERROR]\n{repr(e)}\non {repr(seg)}\n[\ERROR]"
-            traceback.print_exc()
-    return text, entities
+            # Telegram won't play it as a voice note, but the file still gets through
+            logger.error(f"failed to transcode {seg.data['path']}: {e!r}")
+            out.entity = tg.message.File.document((Path(seg.data['path']).name, data))
+            return
+        digest = await media_cache.put(ogg, key)
+    out.digest = digest
+    out.entity = tg.message.File.voice(("voice.ogg", files.enter_context(media_cache.open(digest))))
+
+
+@qq_converters.register_media("video")
+async def convert_video(seg: v11.MessageSegment, out: ConvertedSegment, files: contextlib.ExitStack):
+    out.text += "[video]"
+    # data = await download_file(seg.data['url'])
+    # ret = await v11_bot().call_api("get_file", file=seg.data['file_id'])
+    # print(ret)
+    data = files.enter_context(await open_local_file(seg.data['path'], media_max_size))
+    out.digest = await file_sha256(data)
+    out.entity = tg.message.File.video((out.digest + Path(seg.data['path']).suffix, data))
+
+
+@qq_converters.register_media("file")
+async def convert_file(seg: v11.MessageSegment, out: ConvertedSegment, files: contextlib.ExitStack):
+    out.text += "[file]"
+    # data = await download_file(seg.data['url'])
+    ret = await v11_bot().call_api("get_file", file=seg.data['file_id'])
+    print(ret)
+    data = files.enter_context(await open_local_file(ret['file'], media_max_size))
+    out.digest = await file_sha256(data)
+    out.entity = tg.message.File.document((seg.data['file'], data))
+
+
+async def convert_message(message: v11.Message, files: contextlib.ExitStack):
+    # text, at and face render in place; media are fetched concurrently, then everything is assembled in order
+    parts, pending = qq_converters.split(message)
+    semaphore = asyncio.Semaphore(media_fetch_concurrency)
+
+    async def convert(seg, convert_media):
+        out = ConvertedSegment()
+        async with semaphore:
+            try:
+                await convert_media(seg, out, files)
+            except Exception as e:
+                out.text += f"\n[ERROR]\n{repr(e)}\non {repr(seg)}\n[\\ERROR]"
+                traceback.print_exc()
+        return out
+
+    # a list, not "" + segment, which would slip an empty text entity in front of the files
+    entities = []
+    digests = []
+    converted = await asyncio.gather(*(convert(seg, convert_media) for _, seg, convert_media in pending))
+    for (index, _, _), out in zip(pending, converted):
+        parts[index] = out.text
+        # file segments have no text and are falsy
+        if out.entity is not None:
+            entities.append(out.entity)
+            digests.append(out.digest)
+    return "".join(parts), entities, digests
+
+
+def album_batches(entities, digests) -> list[list]:
+    # consecutive photos/videos (or documents) share one sendMediaGroup call, up to 10 per album;
+    # voice and animations can't be grouped and go alone
+    batches = []
+    kind = None
+    for seg, digest in zip(entities, digests):
+        seg_kind = "media" if seg.type in ("photo", "video") else seg.type if seg.type in ("document", "audio") else None
+        if seg_kind and seg_kind == kind and len(batches[-1]) < ALBUM_LIMIT:
+            batches[-1].append((seg, digest))
+        else:
+            batches.append([(seg, digest)])
+        kind = seg_kind
+    return batches
+
+
+async def send_batch(batch: list, caption, forum_topic_id: int, reply_to: int, tg_bot: tg.Bot):
+    # rebuilt per attempt, a flood-limited send may be retried on a bot with different file_ids
+    bot_entities = tg.Message()
+    uploaded = []
+    names: dict[str, set] = {}
+    for i, (seg, digest) in enumerate(batch):
+        file = seg.data["file"]
+        name = None
+        # file_ids are only valid for the bot that uploaded them
+        if file_id := db.select_tg_file_id(int(tg_bot.self_id), digest, seg.type):
+            file = file_id
+        elif isinstance(file, tuple):
+            name = file[0]
+            # documents keep their QQ names, which two files of one album may share
+            if digest not in names.get(name, {digest}):
+                name = f"{i}-{name}"
+            file = (name, upload_view(file[1]))
+            names.setdefault(name, set()).add(digest)
+        bot_entities += tg.message.File(seg.type, {**seg.data, "file": file})
+        uploaded.append((name, None if file_id else digest))
+    # the adapter sends one part per name, so the file_ids Telegram returns for
+    # a name shared by different files all belong to whichever was sent last
+    clashes = {name for name, digests in names.items() if len(digests) > 1}
+    uploaded = [None if name in clashes else digest for name, digest in uploaded]
+    converted_message = bot_entities + caption if caption else bot_entities
+    with stage_seconds.time(stage="telegram_send"):
+        tg_messages = await tg_bot.send_to(driver.config.chat_id, converted_message, message_thread_id=forum_topic_id, reply_to_message_id=reply_to)
+    if not isinstance(tg_messages, list):
+        tg_messages = [tg_messages]
+    return tg_messages, uploaded
 
 
 async def handle_message(event: v11.event.MessageEvent, qq_unique_id: int, forum_topic_id: int, name: str):
@@ -162,46 +390,220 @@ async def handle_message(event: v11.event.MessageEvent, qq_unique_id: int, forum
         reply_tg_msg_id = None
 
 
-    text, entities = await convert_message(message)
-    if event.reply:
-        text = "[reply]" + text
-    converted_message = entities + tg.message.Entity.underline(name + ": ") + "\n" + text
-
-    tg_bot = telegram_load_balance(reply_tg_bot_id)
-    tg_messages = await tg_bot.send_to(driver.config.chat_id, converted_message, message_thread_id=forum_topic_id, reply_to_message_id=reply_tg_msg_id)
-    if isinstance(tg_messages, list):
+    with contextlib.ExitStack() as files:
+        with stage_seconds.time(stage="convert"):
+            text, entities, digests = await convert_message(message, files)
+        if event.reply:
+            text = "[reply]" + text
+        caption = tg.message.Entity.underline(name + ": ") + "\n" + text
+
+        batches = album_batches(entities, digests)
+        # the caption rides on the first album unless it is too long for one, then it follows as text
+        if not batches or utf16_len(str(caption)) > CAPTION_LIMIT:
+            batches.append([])
+        caption_index = 0 if batches[-1] else len(batches) - 1
+        done = completed_steps.get(set())
+        for i, batch in enumerate(batches):
+            if ("batch", i) in done:
+                continue
+            batch_caption = caption if i == caption_index else None
+            reply_to = reply_tg_msg_id if i == 0 else None
+            tg_bot, (tg_messages, uploaded) = await tg_scheduler.send(
+                driver.config.chat_id,
+                functools.partial(send_batch, batch, batch_caption, forum_topic_id, reply_to),
+                reply_tg_bot_id if i == 0 else None)
+            for tg_message in tg_messages:
+                db.insert_message(DB.Message(qq_unique_id, event.message_id, int(tg_bot.self_id), forum_topic_id, tg_message.message_id))
+            for (seg, _), digest, tg_message in zip(batch, uploaded, tg_messages):
+                if digest and (file_id := sent_file_id(tg_message, seg.type)):
+                    db.insert_tg_file(DB.TgFile(int(tg_bot.self_id), digest, seg.type, file_id))
+            done.add(("batch", i))
+
+
+@dataclass
+class CoalescedBatch:
+    first_seen: float
+    events: list
+    size: int
+
+    async def close(self, qq_unique_id: int):
+        await asyncio.sleep(self.first_seen + coalesce_window - time.monotonic())
+        if open_batches.get(qq_unique_id) is self:
+            del open_batches[qq_unique_id]
+
+
+def is_text_only(event: v11.event.MessageEvent):
+    return not event.reply and all(seg.type in ("text", "at", "face") for seg in event.get_message())
+
+
+def coalesced_size(event: v11.event.MessageEvent) -> int:
+    # what the message adds to a merged Telegram message: the sender label and the rendered text
+    parts, _ = qq_converters.split(event.get_message())
+    name = event.sender.card or event.sender.nickname
+    return utf16_len(name + ": \n" + "".join(parts))
+
+
+def submit_qq_message(qq_unique_id: int, relay, event: v11.event.MessageEvent):
+    key = ("qq", qq_unique_id)
+    if qq_unique_id not in coalesce_qq_ids or not is_text_only(event):
+        # anything else ends the run of consecutive text messages
+        open_batches.pop(qq_unique_id, None)
+        dispatcher.submit(key, relay_job, [event], relay, event)
+        return
+    size = coalesced_size(event)
+    batch = open_batches.get(qq_unique_id)
+    # one more for the newline between merged messages
+    if batch and batch.size + 1 + size <= min(coalesce_max_chars, MESSAGE_LIMIT):
+        batch.events.append(event)
+        batch.size += 1 + size
+        return
+    batch = open_batches[qq_unique_id] = CoalescedBatch(time.monotonic(), [event], size)
+    dispatcher.submit(key, relay_job, batch.events, relay, event, batch)
+
+
+async def handle_coalesced_messages(events: list[v11.event.MessageEvent], qq_unique_id: int, forum_topic_id: int):
+    caption = tg.Message()
+    with contextlib.ExitStack() as files:
+        for event in events:
+            name = event.sender.card or event.sender.nickname
+            with stage_seconds.time(stage="convert"):
+                text, _, _ = await convert_message(event.get_message(), files)
+            if caption:
+                caption += "\n"
+            caption += tg.message.Entity.underline(name + ": ") + "\n" + text
+    tg_bot, (tg_messages, _) = await tg_scheduler.send(
+        driver.config.chat_id, functools.partial(send_batch, [], caption, forum_topic_id, None))
+    # every merged QQ message maps to the one Telegram message so replies to any of them resolve
+    for event in events:
         for tg_message in tg_messages:
             db.insert_message(DB.Message(qq_unique_id, event.message_id, int(tg_bot.self_id), forum_topic_id, tg_message.message_id))
+
+
+async def relay_group_message(event: v11.event.GroupMessageEvent, batch: CoalescedBatch = None):
+    qq_unique_id = -event.group_id  # negative id for groups
+    name = event.sender.card or event.sender.nickname
+    if batch:
+        await batch.close(qq_unique_id)
+    group_info = await get_group_info(event.group_id)
+    forum_topic_id = await get_forum_topic(qq_unique_id, group_info['group_name'])
+    if batch and len(batch.events) > 1:
+        await handle_coalesced_messages(batch.events, qq_unique_id, forum_topic_id)
     else:
-        tg_message = tg_messages
-        db.insert_message(DB.Message(qq_unique_id, event.message_id, int(tg_bot.self_id), forum_topic_id, tg_message.message_id))
+        await handle_message(event, qq_unique_id, forum_topic_id, name)
 
 
-@on(rule=is_type(v11.event.GroupMessageEvent), block=True).handle()
-async def handle_group_message(event: v11.event.GroupMessageEvent, bot: v11.Bot):
-    try:
-        qq_unique_id = -event.group_id  # negative id for groups
-        name = event.sender.card or event.sender.nickname
-        group_info = await get_group_info(bot, event.group_id)
-        forum_topic_id = await get_forum_topic(qq_unique_id, group_info['group_name'])
+async def relay_private_message(event: v11.event.PrivateMessageEvent, batch: CoalescedBatch = None):
+    qq_unique_id = event.sender.user_id
+    name = event.sender.card or event.sender.nickname
+    if batch:
+        await batch.close(qq_unique_id)
+    forum_topic_id = await get_forum_topic(qq_unique_id, name)
+    if batch and len(batch.events) > 1:
+        await handle_coalesced_messages(batch.events, qq_unique_id, forum_topic_id)
+    else:
         await handle_message(event, qq_unique_id, forum_topic_id, name)
+
+
+def outbox_key(event) -> str:
+    if isinstance(event, v11.event.GroupMessageEvent):
+        return f"qq:{-event.group_id}:{event.message_id}"
+    if isinstance(event, v11.event.PrivateMessageEvent):
+        return f"qq:{event.sender.user_id}:{event.message_id}"
+    return f"tg:{event.message_thread_id}:{event.message_id}"
+
+
+OUTBOX_EVENTS = {
+    "qq_group": v11.event.GroupMessageEvent.model_validate_json,
+    "qq_private": v11.event.PrivateMessageEvent.model_validate_json,
+    "tg_topic": lambda payload: tg.Event.parse_event(json.loads(payload)),
+}
+
+
+def accept_event(event, kind: str, payload: str, relayed) -> bool:
+    # both sides may deliver an event again after a reconnect, relay every message once
+    key = outbox_key(event)
+    if relayed or not db.insert_outbox_job(DB.OutboxJob(key, kind, payload, time.time())):
+        logger.info(f"dropping duplicate event {key}")
+        return False
+    return True
+
+
+def route_event(event):
+    match event:
+        case v11.event.GroupMessageEvent():
+            submit_qq_message(-event.group_id, relay_group_message, event)
+        case v11.event.PrivateMessageEvent():
+            submit_qq_message(event.sender.user_id, relay_private_message, event)
+        case tg.event.ForumTopicMessageEvent():
+            submit_topic_message(event)
+
+
+@dataclass
+class RelayProgress:
+    attempts: int = 0
+    done: set = field(default_factory=set)
+
+
+# per outbox key, outlives the attempts of one job
+relay_progress: dict[str, RelayProgress] = {}
+# steps of the running job that already reached the other side, a retry skips them instead of sending twice
+completed_steps: contextvars.ContextVar[set] = contextvars.ContextVar("completed_steps")
+
+
+def replay_outbox():
+    # jobs left over from the last run go back on their conversation queues in arrival order
+    jobs = db.select_outbox_jobs()
+    if jobs:
+        logger.info(f"replaying {len(jobs)} unfinished relay jobs")
+    for job in jobs:
+        try:
+            route_event(OUTBOX_EVENTS[job.kind](job.payload))
+        except Exception:
+            traceback.print_exc()
+            db.delete_outbox_job(job.key)
+
+
+async def relay_job(events: list, relay, *args):
+    # events is the live list of messages the job covers, an open batch or album keeps growing until the relay runs
+    direction = "tg_to_qq" if isinstance(events[0], tg.Event) else "qq_to_tg"
+    key = outbox_key(events[0])
+    progress = relay_progress.setdefault(key, RelayProgress())
+    progress.attempts += 1
+    completed_steps.set(progress.done)
+    try:
+        await outbox.run(relay, *args, attempt=progress.attempts)
+        metrics.relayed.inc(len(events), direction=direction)
+        if "first_relay" not in startup_seconds:
+            startup_seconds["first_relay"] = process_uptime()
+            logger.info(f"first message relayed {startup_seconds['first_relay']:.2f}s after start")
+    except Retry:
+        # back on the conversation queue after the backoff, the worker is free meanwhile
+        raise
     except Exception as e:
-        error_msg = f"\n[ERROR]\n{repr(e)}\non {repr(event)}\n[\ERROR]"
-        await telegram_master().send_to(driver.config.chat_id, error_msg)
+        metrics.relay_failures.inc(len(events), direction=direction)
         traceback.print_exc()
+        error_msg = f"\n[ERROR]\n{repr(e)}\non {repr(events[0])}\n[\\ERROR]"
+        try:
+            await telegram_master().send_to(driver.config.chat_id, error_msg)
+        except Exception:
+            logger.error(f"failed to report {error_msg}")
+    del relay_progress[key]
+    for event in events:
+        db.delete_outbox_job(outbox_key(event))
+
+
+@on(rule=is_type(v11.event.GroupMessageEvent), block=True).handle()
+async def handle_group_message(event: v11.event.GroupMessageEvent, bot: v11.Bot):
+    relayed = db.select_message_where_qq(-event.group_id, event.message_id)
+    if accept_event(event, "qq_group", event.model_dump_json(), relayed):
+        route_event(event)
 
 
 @on(rule=is_type(v11.event.PrivateMessageEvent), block=True).handle()
 async def handle_private_message(event: v11.event.PrivateMessageEvent, bot: v11.Bot):
-    try:
-        qq_unique_id = event.sender.user_id
-        name = event.sender.card or event.sender.nickname
-        forum_topic_id = await get_forum_topic(qq_unique_id, name)
-        await handle_message(event, qq_unique_id, forum_topic_id, name)
-    except Exception as e:
-        error_msg = f"\n[ERROR]\n{repr(e)}\non {repr(event)}\n[\ERROR]"
-        await telegram_master().send_to(driver.config.chat_id, error_msg)
-        traceback.print_exc()
+    relayed = db.select_message_where_qq(event.sender.user_id, event.message_id)
+    if accept_event(event, "qq_private", event.model_dump_json(), relayed):
+        route_event(event)
 
 
 @on(rule=is_type(v11.event.HeartbeatMetaEvent), block=True).handle()
@@ -221,78 +623,186 @@ async def handle_ls(event: tg.event.GroupMessageEvent, bot: tg.Bot):
 
 @on_command("ls", rule=is_type(tg.event.GroupMessageEvent) & is_telegram_master, block=True).handle()
 async def handle_ls(event: tg.event.GroupMessageEvent, bot: tg.Bot):
-    friend_list = await v11_bot().call_api("get_friend_list")
-    print(friend_list)
     formatted = "FRIENDS:\n"
-    for friend in friend_list:
+    for friend in (await directory.friends.all()).values():
         formatted += f"{friend['remark'] or friend['nickname']}({friend['user_id']})"
         formatted += "\n"
-    group_list = await v11_bot().call_api("get_group_list")
-    print(group_list)
     formatted += "\n\nGROUPS:\n"
-    for group in group_list:
+    for group in (await directory.groups.all()).values():
         formatted += f"{group['group_name']}({-group['group_id']})"
         formatted += "\n"
     await bot.send(event, formatted)
 
 
+@on_command("stats", rule=is_type(tg.event.GroupMessageEvent) & is_telegram_master, block=True).handle()
+async def handle_stats(event: tg.event.GroupMessageEvent, bot: tg.Bot):
+    formatted = "QUEUES:\n"
+    for key, value in dispatcher.stats().items():
+        formatted += f"{key}: {value:.3f}\n" if isinstance(value, float) else f"{key}: {value}\n"
+    formatted += "\nTELEGRAM BOTS:\n"
+    for bot_id, usage in tg_scheduler.stats().items():
+        formatted += f"{bot_id}: " + ", ".join(f"{key}={value:.3g}" for key, value in usage.items()) + "\n"
+    formatted += "\nOUTBOX:\n"
+    formatted += f"pending: {len(db.select_outbox_jobs())}\n"
+    for key, value in outbox.stats().items():
+        formatted += f"{key}: {value}\n"
+    formatted += "\nMEDIA CACHE:\n"
+    for key, value in media_cache.stats().items():
+        formatted += f"{key}: {value}\n"
+    formatted += "\nSTARTUP:\n"
+    for key, value in startup_seconds.items():
+        formatted += f"{key}: {value:.2f}s\n"
+    await bot.send(event, formatted)
+
+
 @on_command("touch", rule=is_type(tg.event.GroupMessageEvent) & is_telegram_master, block=True).handle()
 async def handle_touch(event: tg.event.GroupMessageEvent, bot: tg.Bot, message: tg.Message = CommandArg()):
     if user_id := message.extract_plain_text():
-        if user_id.startswith("-"):
-            group_list = await v11_bot().call_api("get_group_list")
-            for group in group_list:
-                if str(-group['group_id']) == user_id:
-                    forum_topic_id = await get_forum_topic(-group['group_id'], group['group_name'])
-                    await bot.send(event, f"successfully created topic {forum_topic_id}")
-                    break
+        if not user_id.lstrip("-").isdigit():
+            await bot.send(event, f"failed to create forum topic for {user_id}")
+        elif user_id.startswith("-"):
+            if group := await directory.groups.get(-int(user_id)):
+                forum_topic_id = await get_forum_topic(-group['group_id'], group['group_name'])
+                await bot.send(event, f"successfully created topic {forum_topic_id}")
             else:
                 await bot.send(event, f"failed to create forum topic for {user_id}")
         else:
-            friend_list = await v11_bot().call_api("get_friend_list")
-            for friend in friend_list:
-                if str(friend['user_id']) == user_id:
-                    forum_topic_id = await get_forum_topic(friend['user_id'], friend['remark'] or friend['nickname'])
-                    await bot.send(event, f"successfully created topic {forum_topic_id}")
-                    break
+            if friend := await directory.friends.get(int(user_id)):
+                forum_topic_id = await get_forum_topic(friend['user_id'], friend['remark'] or friend['nickname'])
+                await bot.send(event, f"successfully created topic {forum_topic_id}")
             else:
                 await bot.send(event, f"failed to create forum topic for {user_id}")
     else:
         await bot.send(event, "Usage: /touch USER_ID or /touch -GROUP_ID")
 
 
-@on(rule=is_type(tg.event.ForumTopicMessageEvent) & is_telegram_master, block=True).handle()
-async def handle_topic_message(event: tg.event.ForumTopicMessageEvent, bot: tg.Bot):
-    forum_topic_id = event.message_thread_id
+def tg_file_url(bot: tg.Bot, file) -> str:
+    return f"{bot.bot_config.api_server}file/bot{bot.bot_config.token}/{file.file_path}"
+
+
+async def fetch_tg_file(bot: tg.Bot, file) -> str:
+    key = f"tg:{file.file_unique_id}"
+    if digest := media_cache.resolve(key):
+        return digest
+    with stage_seconds.time(stage="download"):
+        data = await download_to_file(tg_file_url(bot, file), media_max_size, media_spool_threshold)
+    with data:
+        return await media_cache.put(data, key)
+
+
+def transfer_strategy(seg_type: str, size: int) -> str:
+    if size is not None and size <= media_inline_max_size:
+        return "bytes"
+    return media_transfer.get(seg_type, "bytes")
+
+
+def transcoder_source(digest: str):
+    # worker processes can't share our file handles, they read the cached blob themselves
+    blob = media_cache.blob_path(digest)
+    return str(blob) if blob.exists() else media_cache.read(digest)
+
+
+def cached_media_file(seg_type: str, digest: str):
+    # media that only exist in our cache go inline or by path, never by url
+    if transfer_strategy(seg_type, media_cache.blob_size(digest)) != "path":
+        return media_cache.read(digest)
+    if media_cache_remote_dir:
+        # the OneBot implementation may see the cache directory under another path
+        return PurePosixPath(media_cache_remote_dir, "blobs", digest).as_uri()
+    return media_cache.blob_path(digest)
+
+
+async def tg_media_file(bot: tg.Bot, seg_type: str, file):
+    if transfer_strategy(seg_type, file.file_size) == "url":
+        return tg_file_url(bot, file)
+    return cached_media_file(seg_type, await fetch_tg_file(bot, file))
+
+
+@tg_converters.register_media("photo")
+async def convert_tg_photo(bot: tg.Bot, seg: tg.MessageSegment, qq_unique_id: int):
+    file = await bot.get_file(file_id=seg.data["file"])
+    return v11.message.MessageSegment.image(await tg_media_file(bot, seg.type, file))
+
+
+@tg_converters.register_media("video")
+async def convert_tg_video(bot: tg.Bot, seg: tg.MessageSegment, qq_unique_id: int):
+    file = await bot.get_file(file_id=seg.data["file"])
+    return v11.message.MessageSegment.video(await tg_media_file(bot, seg.type, file))
+
+
+@tg_converters.register_media("document")
+async def convert_tg_document(bot: tg.Bot, seg: tg.MessageSegment, qq_unique_id: int):
+    done = completed_steps.get(set())
+    if ("document", seg.data["file"]) in done:
+        return
+    file = await bot.get_file(file_id=seg.data["file"])
+    await v11_bot().call_api("upload_private_file", user_id=qq_unique_id, file=tg_file_url(bot, file), name=file.file_path)
+    done.add(("document", seg.data["file"]))
+
+
+@tg_converters.register_media("sticker", "animation")
+async def convert_tg_animation(bot: tg.Bot, seg: tg.MessageSegment, qq_unique_id: int):
+    file = await bot.get_file(file_id=seg.data["file"])
+    key = f"tg:gif:{file.file_unique_id}"
+    if not (digest := media_cache.resolve(key)):
+        source = await fetch_tg_file(bot, file)
+        with stage_seconds.time(stage="transcode"):
+            data = await transcoder.run(to_gif, transcoder_source(source), gif_max_dimension, gif_fps, gif_max_frames)
+        digest = await media_cache.put(data, key)
+    return v11.message.MessageSegment.image(cached_media_file(seg.type, digest))
+
+
+@tg_converters.register_media("voice")
+async def convert_tg_voice(bot: tg.Bot, seg: tg.MessageSegment, qq_unique_id: int):
+    file = await bot.get_file(file_id=seg.data["file"])
+    if not voice_transcode:
+        return v11.message.MessageSegment.record(await tg_media_file(bot, seg.type, file))
+    key = f"tg:{qq_voice_format}:{file.file_unique_id}"
+    if not (digest := media_cache.resolve(key)):
+        source = await fetch_tg_file(bot, file)
+        try:
+            with stage_seconds.time(stage="transcode"):
+                data = await transcoder.run(to_qq_voice, transcoder_source(source), qq_voice_format)
+        except Exception as e:
+            # QQ may not play the OGG, but the voice still gets through with the rest of the message
+            logger.error(f"failed to transcode voice {file.file_unique_id}: {e!r}")
+            return v11.message.MessageSegment.record(await tg_media_file(bot, seg.type, file))
+        digest = await media_cache.put(data, key)
+    return v11.message.MessageSegment.record(cached_media_file(seg.type, digest))
+
+
+async def convert_tg_message(bot: tg.Bot, segs, qq_unique_id: int) -> v11.Message:
+    parts, pending = tg_converters.split(segs)
+    semaphore = asyncio.Semaphore(media_fetch_concurrency)
+
+    async def convert(seg, convert_media):
+        async with semaphore:
+            return await convert_media(bot, seg, qq_unique_id)
+
+    converted = await asyncio.gather(*(convert(seg, convert_media) for _, seg, convert_media in pending))
+    for (index, _, _), seg in zip(pending, converted):
+        parts[index] = seg
+    message = segments.MessageBuilder()
+    for part in parts:
+        if isinstance(part, str):
+            message.append_text(part)
+        elif part is not None:
+            message.append(part)
+    return message.build()
+
+
+async def relay_topic_messages(events: list[tg.event.ForumTopicMessageEvent]):
+    # several events are the items of one album, relayed as a single QQ message
+    bot = telegram_master()
+    forum_topic_id = events[0].message_thread_id
     qq_unique_id = db.select_qq_unique_id(tg_forum_topic_id=forum_topic_id)
+    # outbox rows written before unmapped topics were skipped
+    if qq_unique_id is None:
+        return
 
-    converted_message = ""
-    for seg in event.get_message():
-        match seg.type:
-            case _ if seg.is_text():
-                converted_message += seg.data.get("text", "")
-            case "photo":
-                file = await bot.get_file(file_id=seg.data["file"])
-                url = f"https://api.telegram.org/file/bot{bot.bot_config.token}/{file.file_path}"
-                data = await download_file(url)
-                converted_message += v11.message.MessageSegment.image(data)
-            case "video":
-                file = await bot.get_file(file_id=seg.data["file"])
-                url = f"https://api.telegram.org/file/bot{bot.bot_config.token}/{file.file_path}"
-                data = await download_file(url)
-                # converted_message += v11.message.MessageSegment.video(data)
-            case "document":
-                file = await bot.get_file(file_id=seg.data["file"])
-                url = f"https://api.telegram.org/file/bot{bot.bot_config.token}/{file.file_path}"
-                await v11_bot().call_api("upload_private_file", user_id=qq_unique_id, file=url, name=file.file_path)
-            case "sticker" | "animation":
-                file = await bot.get_file(file_id=seg.data["file"])
-                url = f"https://api.telegram.org/file/bot{bot.bot_config.token}/{file.file_path}"
-                frames = iio.imread(await download_file(url), index=None, plugin="pyav", format="rgba")
-                data = iio.imwrite("<bytes>", frames, extension=".gif", duration=50, loop=0)
-                converted_message += v11.message.MessageSegment.image(data)
-            case _:
-                converted_message += seg.type
+    with stage_seconds.time(stage="convert"):
+        converted_message = await convert_tg_message(
+            bot, itertools.chain.from_iterable(event.get_message() for event in events), qq_unique_id)
 
     if not converted_message:
         return
@@ -302,17 +812,48 @@ async def handle_topic_message(event: tg.event.ForumTopicMessageEvent, bot: tg.B
         event_dict['user_id'] = qq_unique_id
     else:
         event_dict['group_id'] = -qq_unique_id
-    if event.reply_to_message:
+    if reply_event := next((event for event in events if event.reply_to_message), None):
         reply_to_db_message = db.select_message_where_tg(tg_forum_topic_id=forum_topic_id, 
-                                                         tg_msg_id=event.reply_to_message.message_id)
+                                                         tg_msg_id=reply_event.reply_to_message.message_id)
         if reply_to_db_message:
             event_dict['message_id'] = reply_to_db_message.qq_msg_id
     pseudo_event = lambda: None
     pseudo_event.model_dump = lambda *args, **kwargs: event_dict
 
-    res = await v11_bot().send(pseudo_event, converted_message, reply_message='message_id' in event_dict)
+    with stage_seconds.time(stage="qq_send"):
+        res = await v11_bot().send(pseudo_event, converted_message, reply_message='message_id' in event_dict)
     qq_msg_id = res['message_id']
-    db.insert_message(DB.Message(qq_unique_id, qq_msg_id, int(telegram_master().self_id), forum_topic_id, event.message_id))
+    for event in events:
+        db.insert_message(DB.Message(qq_unique_id, qq_msg_id, int(telegram_master().self_id), forum_topic_id, event.message_id))
+
+
+async def relay_topic_album(media_group_id: str, first_seen: float, events: list):
+    # the job is queued with the first item, so later messages in the topic still wait behind the album
+    await asyncio.sleep(first_seen + album_gather_window - time.monotonic())
+    if pending_albums.get(media_group_id, (None, None))[1] is events:
+        del pending_albums[media_group_id]
+    await relay_topic_messages(sorted(events, key=lambda event: event.message_id))
+
+
+def submit_topic_message(event: tg.event.ForumTopicMessageEvent):
+    key = ("tg", event.message_thread_id)
+    if not event.media_group_id:
+        dispatcher.submit(key, relay_job, [event], relay_topic_messages, [event])
+    elif event.media_group_id in pending_albums:
+        pending_albums[event.media_group_id][1].append(event)
+    else:
+        first_seen, events = pending_albums[event.media_group_id] = (time.monotonic(), [event])
+        dispatcher.submit(key, relay_job, events, relay_topic_album, event.media_group_id, first_seen, events)
+
+
+@on(rule=is_type(tg.event.ForumTopicMessageEvent) & is_telegram_master, block=True).handle()
+async def handle_topic_message(event: tg.event.ForumTopicMessageEvent, bot: tg.Bot):
+    # topics the bridge didn't create have no QQ chat to relay to
+    if db.select_qq_unique_id(event.message_thread_id) is None:
+        return
+    relayed = db.select_message_where_tg(event.message_thread_id, event.message_id)
+    if accept_event(event, "tg_topic", json.dumps(event.raw_update), relayed):
+        route_event(event)
 
 
 @on(rule=is_type(tg.Event) & is_telegram_master, priority=10).handle()
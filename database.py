@@ -1,6 +1,65 @@
+import atexit
+from collections import deque
+import itertools
 import sqlite3
+import threading
+import traceback
 from dataclasses import dataclass
 
+from metrics import stage_seconds
+from utils import LRUCache
+
+
+# append-only, the database's PRAGMA user_version is the number of migrations applied
+MIGRATIONS = [
+    [
+        """
+CREATE TABLE IF NOT EXISTS message (
+    qq_unique_id INT NOT NULL,
+    qq_msg_id INT NOT NULL,
+    tg_bot_id INT NOT NULL,
+    tg_forum_topic_id INT NOT NULL,
+    tg_msg_id INT NOT NULL
+)""",
+        """
+CREATE TABLE IF NOT EXISTS forum_topic (
+    qq_unique_id INT NOT NULL,
+    tg_forum_topic_id INT NOT NULL
+)""",
+        """
+CREATE TABLE IF NOT EXISTS tg_file (
+    tg_bot_id INT NOT NULL,
+    digest TEXT NOT NULL,
+    file_type TEXT NOT NULL,
+    tg_file_id TEXT NOT NULL,
+    PRIMARY KEY (tg_bot_id, digest, file_type)
+)""",
+    ],
+    [
+        "CREATE INDEX IF NOT EXISTS message_qq ON message (qq_unique_id, qq_msg_id)",
+        "CREATE INDEX IF NOT EXISTS message_tg ON message (tg_forum_topic_id, tg_msg_id)",
+        # keep the first mapping, which is the one selects used to return
+        "DELETE FROM forum_topic WHERE rowid NOT IN (SELECT MIN(rowid) FROM forum_topic GROUP BY qq_unique_id)",
+        "DELETE FROM forum_topic WHERE rowid NOT IN (SELECT MIN(rowid) FROM forum_topic GROUP BY tg_forum_topic_id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS forum_topic_qq ON forum_topic (qq_unique_id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS forum_topic_tg ON forum_topic (tg_forum_topic_id)",
+    ],
+    [
+        """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT NOT NULL UNIQUE,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    created REAL NOT NULL
+)""",
+    ],
+    [
+        # albums used to upload every image under one name, so their file_ids may point at another image
+        "DELETE FROM tg_file",
+    ],
+]
+
 
 @dataclass
 class Message:
@@ -15,69 +74,228 @@ class ForumTopic:
     tg_forum_topic_id: int
     qq_unique_id: int
 
+@dataclass
+class TgFile:
+    tg_bot_id: int
+    digest: str
+    file_type: str
+    tg_file_id: str
+
+@dataclass
+class OutboxJob:
+    key: str
+    kind: str
+    payload: str
+    created: float
+
 class Database:
-    def __init__(self, path) -> None:
+    def __init__(self, path, write_behind: bool = False, batch_size: int = 100, flush_interval: float = 0.5,
+                 message_cache_size: int = 65536) -> None:
+        self.path = path
+        self.write_behind = write_behind
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
         self.con = sqlite3.connect(path)
-        # self.con.execute("DROP TABLE message")
-        self.con.execute("""
-CREATE TABLE IF NOT EXISTS message (
-    qq_unique_id INT NOT NULL,
-    qq_msg_id INT NOT NULL,
-    tg_bot_id INT NOT NULL,
-    tg_forum_topic_id INT NOT NULL,
-    tg_msg_id INT NOT NULL
-)""")
-        self.con.execute("""
-CREATE TABLE IF NOT EXISTS forum_topic (
-    qq_unique_id INT NOT NULL,
-    tg_forum_topic_id INT NOT NULL
-)""")
-        self.con.commit()
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute("PRAGMA synchronous=NORMAL")
+        self.migrate()
+
+        # forum topics are few and looked up on every message, keep the whole mapping in memory both ways
+        self._topic_by_qq = {}
+        self._topic_by_tg = {}
+        for qq_unique_id, tg_forum_topic_id in self.con.execute("SELECT qq_unique_id, tg_forum_topic_id FROM forum_topic"):
+            self._topic_by_qq.setdefault(qq_unique_id, tg_forum_topic_id)
+            self._topic_by_tg.setdefault(tg_forum_topic_id, qq_unique_id)
+        # unfinished relay jobs in arrival order, also the set of keys a redelivered event is checked against
+        self._outbox = {}
+        # a database held at an older version (bench_db opens one at v1) has no outbox yet
+        if self.con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'outbox'").fetchone():
+            for row in self.con.execute("SELECT key, kind, payload, created FROM outbox ORDER BY id"):
+                self._outbox[row[0]] = OutboxJob(*row)
+        self._message_by_qq = LRUCache(message_cache_size)
+        self._message_by_tg = LRUCache(message_cache_size)
+
+        # write-behind: rows wait in _pending until the writer thread commits them in batches,
+        # selects look at _pending too so callers always read their own writes
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closing = False
+        self._writer = None
+        if write_behind:
+            self._writer = threading.Thread(target=self._write_loop, name="database-writer", daemon=True)
+            self._writer.start()
+            atexit.register(self.close)
+
+    def migrate(self):
+        version = self.con.execute("PRAGMA user_version").fetchone()[0]
+        for version, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+            try:
+                self.con.execute("BEGIN")
+                for statement in statements:
+                    self.con.execute(statement)
+                self.con.execute(f"PRAGMA user_version = {version}")
+                self.con.commit()
+            except sqlite3.Error:
+                self.con.rollback()
+                raise
+
+    def _write(self, sql: str, params: tuple, obj):
+        if not self.write_behind:
+            with stage_seconds.time(stage="db_write"):
+                self.con.execute(sql, params)
+                self.con.commit()
+            return
+        with self._lock:
+            self._pending.append((sql, params, obj))
+            pending = len(self._pending)
+        if pending >= self.batch_size:
+            self._wake.set()
+
+    def _write_loop(self):
+        con = sqlite3.connect(self.path)
+        con.execute("PRAGMA synchronous=NORMAL")
+        while not self._closing:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self._flush(con)
+        self._flush(con)
+        con.close()
+
+    def _flush(self, con: sqlite3.Connection):
+        while True:
+            with self._lock:
+                batch = list(itertools.islice(self._pending, self.batch_size))
+            if not batch:
+                return
+            try:
+                with stage_seconds.time(stage="db_write"), con:
+                    for sql, params, _ in batch:
+                        con.execute(sql, params)
+            except sqlite3.Error:
+                # retry row by row so one bad row doesn't drop the whole batch
+                for sql, params, _ in batch:
+                    try:
+                        with con:
+                            con.execute(sql, params)
+                    except sqlite3.Error:
+                        traceback.print_exc()
+            with self._lock:
+                for _ in batch:
+                    self._pending.popleft()
+
+    def _pending_rows(self, cls) -> list:
+        with self._lock:
+            return [obj for _, _, obj in self._pending if isinstance(obj, cls)]
+
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def close(self):
+        if self._writer and not self._closing:
+            self._closing = True
+            self._wake.set()
+            self._writer.join()
+        self.con.close()
+
+    def _cache_message(self, obj: Message):
+        # the first row for a message wins, like the unordered SELECTs below
+        qq_key = (obj.qq_unique_id, str(obj.qq_msg_id))
+        if qq_key not in self._message_by_qq:
+            self._message_by_qq.put(qq_key, obj)
+        tg_key = (obj.tg_forum_topic_id, obj.tg_msg_id)
+        if tg_key not in self._message_by_tg:
+            self._message_by_tg.put(tg_key, obj)
 
     def insert_message(self, obj: Message):
-        self.con.execute("INSERT INTO message VALUES(?, ?, ?, ?, ?)", (
+        self._cache_message(obj)
+        self._write("INSERT INTO message VALUES(?, ?, ?, ?, ?)", (
             obj.qq_unique_id,
             obj.qq_msg_id,
             obj.tg_bot_id,
             obj.tg_forum_topic_id,
             obj.tg_msg_id
-        ))
-        self.con.commit()
+        ), obj)
 
     def insert_forum_topic(self, obj: ForumTopic):
-        self.con.execute("INSERT INTO forum_topic VALUES(?, ?)", (
+        self._topic_by_qq.setdefault(obj.qq_unique_id, obj.tg_forum_topic_id)
+        self._topic_by_tg.setdefault(obj.tg_forum_topic_id, obj.qq_unique_id)
+        self._write("INSERT INTO forum_topic VALUES(?, ?)", (
             obj.qq_unique_id,
             obj.tg_forum_topic_id
-        ))
+        ), obj)
+
+    def insert_tg_file(self, obj: TgFile):
+        self._write("INSERT OR REPLACE INTO tg_file VALUES(?, ?, ?, ?)", (
+            obj.tg_bot_id,
+            obj.digest,
+            obj.file_type,
+            obj.tg_file_id
+        ), obj)
+
+    def insert_outbox_job(self, obj: OutboxJob) -> bool:
+        if obj.key in self._outbox:
+            return False
+        self._outbox[obj.key] = obj
+        self._write("INSERT OR IGNORE INTO outbox (key, kind, payload, created) VALUES(?, ?, ?, ?)", (
+            obj.key,
+            obj.kind,
+            obj.payload,
+            obj.created
+        ), obj)
+        return True
+
+    def delete_outbox_job(self, key: str):
+        if self._outbox.pop(key, None):
+            self._write("DELETE FROM outbox WHERE key = ?", (key,), None)
+
+    def select_outbox_jobs(self) -> list[OutboxJob]:
+        return list(self._outbox.values())
 
     def select_qq_unique_id(self, tg_forum_topic_id: int) -> int:
-        cur = self.con.execute("SELECT qq_unique_id FROM forum_topic WHERE tg_forum_topic_id = ?", 
-                               (tg_forum_topic_id, ))
-        row = cur.fetchone()
-        if not row:
-            return None
-        return row[0]
+        return self._topic_by_tg.get(tg_forum_topic_id)
 
     def select_tg_forum_topic_id(self, qq_unique_id: int) -> int:
-        cur = self.con.execute("SELECT tg_forum_topic_id FROM forum_topic WHERE qq_unique_id = ?", 
-                               (qq_unique_id, ))
-        row = cur.fetchone()
-        if not row:
-            return None
-        return row[0]
+        return self._topic_by_qq.get(qq_unique_id)
 
     def select_message_where_qq(self, qq_unique_id: int, qq_msg_id: int) -> Message:
+        if obj := self._message_by_qq.get((qq_unique_id, str(qq_msg_id))):
+            return obj
         cur = self.con.execute("SELECT * FROM message WHERE qq_unique_id = ? AND qq_msg_id = ?", 
                                (qq_unique_id, qq_msg_id))
         row = cur.fetchone()
         if not row:
+            for obj in self._pending_rows(Message):
+                # reply segments carry the message id as a string
+                if obj.qq_unique_id == qq_unique_id and str(obj.qq_msg_id) == str(qq_msg_id):
+                    return obj
             return None
-        return Message(*row)
+        obj = Message(*row)
+        self._cache_message(obj)
+        return obj
 
     def select_message_where_tg(self, tg_forum_topic_id: int, tg_msg_id: int) -> Message:
+        if obj := self._message_by_tg.get((tg_forum_topic_id, tg_msg_id)):
+            return obj
         cur = self.con.execute("SELECT * FROM message WHERE tg_forum_topic_id = ? AND tg_msg_id = ?", 
                                (tg_forum_topic_id, tg_msg_id))
         row = cur.fetchone()
+        if not row:
+            for obj in self._pending_rows(Message):
+                if obj.tg_forum_topic_id == tg_forum_topic_id and obj.tg_msg_id == tg_msg_id:
+                    return obj
+            return None
+        obj = Message(*row)
+        self._cache_message(obj)
+        return obj
+
+    def select_tg_file_id(self, tg_bot_id: int, digest: str, file_type: str) -> str:
+        for obj in reversed(self._pending_rows(TgFile)):
+            if (obj.tg_bot_id, obj.digest, obj.file_type) == (tg_bot_id, digest, file_type):
+                return obj.tg_file_id
+        cur = self.con.execute("SELECT tg_file_id FROM tg_file WHERE tg_bot_id = ? AND digest = ? AND file_type = ?", 
+                               (tg_bot_id, digest, file_type))
+        row = cur.fetchone()
         if not row:
             return None
-        return Message(*row)
+        return row[0]
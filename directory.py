@@ -0,0 +1,85 @@
+import asyncio
+import time
+import traceback
+
+from nonebot import logger
+
+from utils import SingleFlight
+
+
+class DirectoryList:
+    def __init__(self, name: str, fetch, id_key: str, ttl: float, miss_interval: float) -> None:
+        self.name = name
+        self.fetch = fetch
+        self.id_key = id_key
+        self.ttl = ttl
+        self.miss_interval = miss_interval
+        self.entries: dict[int, dict] = {}
+        self.fetched_at = None
+        self._flight = SingleFlight()
+
+    def stale(self) -> bool:
+        return self.fetched_at is None or time.monotonic() - self.fetched_at > self.ttl
+
+    async def _fetch(self):
+        entries = await self.fetch()
+        self.entries = {entry[self.id_key]: entry for entry in entries}
+        self.fetched_at = time.monotonic()
+        logger.info(f"refreshed {len(self.entries)} {self.name}")
+
+    async def refresh(self):
+        await self._flight.do(self.name, self._fetch)
+
+    def _revalidate(self):
+        # stale-while-revalidate: callers keep the old entries while a refresh runs in the background
+        asyncio.ensure_future(self.refresh()).add_done_callback(self._log_failure)
+
+    def _log_failure(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception():
+            logger.error(f"failed to refresh {self.name}: {task.exception()!r}")
+
+    async def all(self) -> dict[int, dict]:
+        if self.fetched_at is None:
+            await self.refresh()
+        elif self.stale():
+            self._revalidate()
+        return self.entries
+
+    async def get(self, id: int) -> dict:
+        entries = await self.all()
+        # an unknown id may be a chat joined since the last refresh, refetch at most once per miss_interval
+        if id not in entries and time.monotonic() - self.fetched_at > self.miss_interval:
+            await self.refresh()
+        return self.entries.get(id)
+
+
+class Directory:
+    def __init__(self, fetch_groups, fetch_friends, ttl: float = 600, miss_interval: float = 30) -> None:
+        self.ttl = ttl
+        self.groups = DirectoryList("groups", fetch_groups, "group_id", ttl, miss_interval)
+        self.friends = DirectoryList("friends", fetch_friends, "user_id", ttl, miss_interval)
+        self._task: asyncio.Task = None
+
+    def prefetch(self):
+        # fills both lists in the background, so the first message from each chat doesn't wait on them
+        for directory_list in (self.groups, self.friends):
+            directory_list._revalidate()
+
+    def start(self):
+        if not self._task:
+            self._task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.ttl)
+            for directory_list in (self.groups, self.friends):
+                try:
+                    await directory_list.refresh()
+                except Exception:
+                    traceback.print_exc()
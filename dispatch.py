@@ -0,0 +1,96 @@
+import asyncio
+import time
+import traceback
+from collections import deque
+
+from nonebot import logger
+
+
+class Retry(Exception):
+    # raised by a job to run again after delay: its conversation waits behind it, the worker moves on
+    def __init__(self, delay: float) -> None:
+        super().__init__(delay)
+        self.delay = delay
+
+
+class Dispatcher:
+    def __init__(self, workers: int = 16) -> None:
+        self.workers = workers
+        self.delayed = 0
+        self.last_lag = 0
+        self.max_lag = 0
+        self._queues: dict[object, deque] = {}
+        self._ready = asyncio.Queue()
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self):
+        while len(self._tasks) < self.workers:
+            self._tasks.append(asyncio.create_task(self._work()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, key, fn, *args) -> asyncio.Future:
+        # jobs with the same key run one at a time in submission order, different keys run in parallel
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+            self._ready.put_nowait(key)
+        queue.append((time.monotonic(), future, fn, args))
+        return future
+
+    async def _work(self):
+        while True:
+            key = await self._ready.get()
+            queue = self._queues[key]
+            enqueued_at, future, fn, args = queue.popleft()
+            self.last_lag = time.monotonic() - enqueued_at
+            self.max_lag = max(self.max_lag, self.last_lag)
+            retry = None
+            try:
+                result = await fn(*args)
+                if not future.done():
+                    future.set_result(result)
+            except Retry as e:
+                retry = e
+                queue.appendleft((enqueued_at, future, fn, args))
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                logger.error(f"job {fn.__name__} for {key} failed")
+                traceback.print_exc()
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                if retry:
+                    self.delayed += 1
+                    asyncio.get_running_loop().call_later(retry.delay, self._wake, key)
+                elif queue:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._queues[key]
+
+    def _wake(self, key):
+        self.delayed -= 1
+        self._ready.put_nowait(key)
+
+    def depth(self, key=None) -> int:
+        if key is not None:
+            return len(self._queues.get(key, ()))
+        return sum(len(queue) for queue in self._queues.values())
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "conversations": len(self._queues),
+            "delayed": self.delayed,
+            "depth": self.depth(),
+            "oldest_lag": max((now - queue[0][0] for queue in self._queues.values() if queue), default=0),
+            "last_lag": self.last_lag,
+            "max_lag": self.max_lag,
+        }
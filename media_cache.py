@@ -0,0 +1,142 @@
+import asyncio
+import contextlib
+import hashlib
+import io
+import os
+import tempfile
+from collections import OrderedDict
+from pathlib import Path
+
+from utils import LRUCache, CHUNK_SIZE
+
+
+class MediaCache:
+    def __init__(self, path, max_size: int = 512 * 1024 * 1024, memory_size: int = 32 * 1024 * 1024,
+                 memory_item_size: int = 1024 * 1024, max_keys: int = 65536) -> None:
+        self.path = Path(path)
+        self.blobs_path = self.path / "blobs"
+        self.keys_path = self.path / "keys"
+        self.blobs_path.mkdir(parents=True, exist_ok=True)
+        self.keys_path.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.memory_item_size = memory_item_size
+        self.memory = LRUCache(memory_size, sizeof=len)
+        self.keys = LRUCache(max_keys)
+        self.meta = LRUCache(max_keys)
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self._blobs = OrderedDict()
+        for blob in sorted(self.blobs_path.iterdir(), key=lambda blob: blob.stat().st_mtime):
+            if blob.suffix == ".tmp":
+                blob.unlink()
+                continue
+            self._blobs[blob.name] = blob.stat().st_size
+            self.size += self._blobs[blob.name]
+        # key files by the blob they point at, so evicting a blob takes its aliases with it
+        self._aliases: dict[str, set[str]] = {}
+        for key_path in self.keys_path.iterdir():
+            digest = key_path.read_text()
+            if digest in self._blobs:
+                self._aliases.setdefault(digest, set()).add(key_path.name)
+            else:
+                key_path.unlink()
+        self._evict()
+
+    def _key_path(self, key: str) -> Path:
+        return self.keys_path / hashlib.sha1(key.encode()).hexdigest()
+
+    def blob_path(self, digest: str) -> Path:
+        return self.blobs_path / digest
+
+    def _evict(self):
+        while self.size > self.max_size and self._blobs:
+            digest, size = self._blobs.popitem(last=False)
+            self.size -= size
+            self.memory.pop(digest)
+            self.meta.pop(digest)
+            self.blob_path(digest).unlink(missing_ok=True)
+            for name in self._aliases.pop(digest, ()):
+                key_path = self.keys_path / name
+                # the key may have been pointed at a newer blob since
+                with contextlib.suppress(FileNotFoundError):
+                    if key_path.read_text() == digest:
+                        key_path.unlink()
+
+    def resolve(self, key: str) -> str:
+        digest = self.keys.get(key)
+        if digest is None:
+            key_path = self._key_path(key)
+            if key_path.exists():
+                digest = key_path.read_text()
+        if digest and digest in self._blobs:
+            self.keys.put(key, digest)
+            self._blobs.move_to_end(digest)
+            os.utime(self.blob_path(digest))
+            self.hits += 1
+            return digest
+        if digest:
+            self.keys.pop(key)
+            self._key_path(key).unlink(missing_ok=True)
+        self.misses += 1
+        return None
+
+    def blob_size(self, digest: str) -> int:
+        return self._blobs.get(digest)
+
+    def open(self, digest: str):
+        data = self.memory.get(digest)
+        if data is not None:
+            return io.BytesIO(data)
+        return open(self.blob_path(digest), "rb")
+
+    def read(self, digest: str) -> bytes:
+        with self.open(digest) as f:
+            return f.read()
+
+    def _spool(self, data):
+        # hashes and copies into a temporary blob in one pass, the part that scales with the file
+        if isinstance(data, (bytes, bytearray)):
+            data = io.BytesIO(data)
+        data.seek(0)
+        sha256 = hashlib.sha256()
+        head = bytearray()
+        size = 0
+        with tempfile.NamedTemporaryFile(dir=self.blobs_path, suffix=".tmp", delete=False) as tmp:
+            while chunk := data.read(CHUNK_SIZE):
+                sha256.update(chunk)
+                tmp.write(chunk)
+                size += len(chunk)
+                if size <= self.memory_item_size:
+                    head += chunk
+        data.seek(0)
+        return tmp.name, sha256.hexdigest(), size, head
+
+    async def put(self, data, *keys: str) -> str:
+        # up to media_max_size of hashing and copying runs off the loop, the bookkeeping back on it
+        tmp_name, digest, size, head = await asyncio.to_thread(self._spool, data)
+        if digest in self._blobs:
+            os.unlink(tmp_name)
+            self._blobs.move_to_end(digest)
+        else:
+            os.replace(tmp_name, self.blob_path(digest))
+            self._blobs[digest] = size
+            self.size += size
+        if size <= self.memory_item_size:
+            self.memory.put(digest, bytes(head))
+        for key in keys:
+            self.keys.put(key, digest)
+            key_path = self._key_path(key)
+            key_path.write_text(digest)
+            self._aliases.setdefault(digest, set()).add(key_path.name)
+        self._evict()
+        return digest
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._blobs),
+            "size": self.size,
+            "memory_size": self.memory.size,
+        }
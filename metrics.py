@@ -0,0 +1,175 @@
+import contextlib
+import math
+import threading
+import time
+
+from aiohttp import web
+from nonebot import logger
+from nonebot.drivers import URL, ASGIMixin, HTTPServerSetup, Request, Response
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + "}"
+
+
+def _value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: tuple = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append(f"{self.name}{_labels(dict(zip(self.labelnames, key)))} {_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets) + (math.inf,)
+        # per label set: bucket counts (not cumulative), sum
+        self._values: dict[tuple, tuple[list, list]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        index = next(i for i, bound in enumerate(self.buckets) if value <= bound)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * len(self.buckets), [0.0]))
+            counts[index] += 1
+            total[0] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                labels = dict(zip(self.labelnames, key))
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{_labels({**labels, 'le': _value(bound)})} {cumulative}")
+                lines.append(f"{self.name}_sum{_labels(labels)} {_value(total[0])}")
+                lines.append(f"{self.name}_count{_labels(labels)} {cumulative}")
+        return lines
+
+
+class StatsGauges:
+    # exports an existing stats() dict at scrape time, nested dicts become one label
+    def __init__(self, prefix: str, stats, label: str = None) -> None:
+        self.prefix = prefix
+        self.stats = stats
+        self.label = label
+
+    def render(self) -> list[str]:
+        series: dict[str, list[str]] = {}
+        for key, value in self.stats().items():
+            if isinstance(value, dict):
+                for name, sub_value in value.items():
+                    series.setdefault(name, []).append(f"{self.prefix}_{name}{_labels({self.label: key})} {_value(sub_value)}")
+            else:
+                series.setdefault(key, []).append(f"{self.prefix}_{key} {_value(value)}")
+        lines = []
+        for name, samples in series.items():
+            lines.append(f"# TYPE {self.prefix}_{name} gauge")
+            lines.extend(samples)
+        return lines
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: tuple = ()) -> Counter:
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def stats(self, prefix: str, stats, label: str = None) -> StatsGauges:
+        return self.register(StatsGauges(prefix, stats, label))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                logger.error(f"failed to collect {getattr(metric, 'prefix', None) or metric.name}: {e!r}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+stage_seconds = registry.histogram("nb2tg_stage_seconds", "time spent in each relay stage", ("stage",))
+relayed = registry.counter("nb2tg_relayed_messages_total", "messages relayed", ("direction",))
+relay_failures = registry.counter("nb2tg_relay_failures_total", "messages given up on after retries", ("direction",))
+
+
+class MetricsServer:
+    # serves /metrics on the driver's own HTTP server when it has one, otherwise on a small aiohttp server
+    def __init__(self, driver, host: str = "127.0.0.1", port: int = None, path: str = "/metrics") -> None:
+        self.driver = driver
+        self.host = host
+        self.port = port
+        self.path = path
+        self._runner: web.AppRunner = None
+
+    def setup(self):
+        if isinstance(self.driver, ASGIMixin):
+            self.driver.setup_http_server(HTTPServerSetup(URL(self.path), "GET", "metrics", self._handle_driver))
+
+    async def _handle_driver(self, request: Request) -> Response:
+        return Response(200, headers={"Content-Type": CONTENT_TYPE}, content=registry.render())
+
+    async def _handle_aiohttp(self, request: web.Request) -> web.Response:
+        return web.Response(body=registry.render().encode(), headers={"Content-Type": CONTENT_TYPE})
+
+    async def start(self):
+        if isinstance(self.driver, ASGIMixin) or not self.port or self._runner:
+            return
+        app = web.Application()
+        app.router.add_get(self.path, self._handle_aiohttp)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"serving metrics on http://{self.host}:{self.port}{self.path}")
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,56 @@
+import asyncio
+import random
+
+import aiohttp
+from nonebot import logger
+from nonebot.exception import NetworkError
+
+from dispatch import Retry
+from utils import BotUnavailable
+
+# errors an upstream outage produces, anything else is a bug or a rejected message and is not retried;
+# ApiNotAvailable isn't one: the adapters raise it for a 404 or a missing api root, which a retry won't fix
+RETRYABLE = (NetworkError, BotUnavailable, aiohttp.ClientError, asyncio.TimeoutError, ConnectionError)
+
+
+class Outbox:
+    def __init__(self, attempts: int = 10, base_delay: float = 1, max_delay: float = 300,
+                 max_in_flight: int = 8) -> None:
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.in_flight = 0
+        self.retries = 0
+        self.failures = 0
+        self._slots = asyncio.Semaphore(max_in_flight)
+
+    def backoff(self, attempt: int) -> float:
+        # full jitter, so jobs failed by the same outage don't all come back at once
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    async def run(self, fn, *args, attempt: int = 1):
+        # one attempt; a transient failure raises Retry with the backoff, so nothing holds a worker while it waits
+        async with self._slots:
+            self.in_flight += 1
+            try:
+                return await fn(*args)
+            except RETRYABLE as e:
+                if attempt >= self.attempts:
+                    self.failures += 1
+                    raise
+                delay = self.backoff(attempt)
+                logger.warning(f"job {fn.__name__} failed with {e!r}, retry {attempt} in {delay:.1f}s")
+                self.retries += 1
+                raise Retry(delay) from e
+            except Exception:
+                self.failures += 1
+                raise
+            finally:
+                self.in_flight -= 1
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "retries": self.retries,
+            "failures": self.failures,
+        }
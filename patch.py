@@ -11,4 +11,13 @@ path.write_text(code)
 path = Path("/usr/local/lib/python3.11/site-packages/nonebot/adapters/telegram/model.py")
 code = path.read_text()
 code = code.replace('media: str\n', 'media: str | bytes\n')
+# allow streaming uploads from open file handles instead of bytes
+code = code.replace('InputFile = Union[bytes, tuple[str, bytes]]', 'InputFile = Union[bytes, tuple[str, bytes], tuple[str, object]]')
+path.write_text(code)
+
+path = Path("/usr/local/lib/python3.11/site-packages/nonebot/adapters/telegram/adapter.py")
+code = path.read_text()
+# parsing drops fields and mutates the update, keep an untouched copy so the outbox can replay the event
+code = code.replace('event = Event.parse_event(update)\n',
+                    'event = Event.parse_event(json.loads(json.dumps(update)))\n            event.raw_update = update\n')
 path.write_text(code)
@@ -0,0 +1,134 @@
+import asyncio
+import re
+import time
+from dataclasses import dataclass
+
+from nonebot import logger
+
+from utils import BotUnavailable
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        self._refill(now)
+        return max(0, (1 - self.tokens) / self.rate)
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+
+@dataclass
+class BotUsage:
+    sent: int = 0
+    errors: int = 0
+    flood_waits: int = 0
+    parked_until: float = 0
+    busy: float = 0
+
+
+def retry_after(e: Exception):
+    # the telegram adapter raises a plain NetworkError carrying the 429 response body
+    if match := re.search(r"\b429\b.*\"retry_after\":\s*(\d+)", str(e), re.S):
+        return int(match[1])
+    return None
+
+
+class TelegramScheduler:
+    def __init__(self, get_bots, bot_rate: float = 30, bot_burst: float = 30, chat_rate: float = 20 / 60,
+                 chat_burst: float = 20, attempts: int = 3) -> None:
+        self.get_bots = get_bots
+        self.bot_rate = bot_rate
+        self.bot_burst = bot_burst
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.attempts = attempts
+        self.started = time.monotonic()
+        self.usage: dict[str, BotUsage] = {}
+        self._bot_buckets: dict[str, TokenBucket] = {}
+        self._chat_buckets: dict[tuple, TokenBucket] = {}
+
+    def _usage(self, bot) -> BotUsage:
+        return self.usage.setdefault(bot.self_id, BotUsage())
+
+    def _bot_bucket(self, bot) -> TokenBucket:
+        if bot.self_id not in self._bot_buckets:
+            self._bot_buckets[bot.self_id] = TokenBucket(self.bot_rate, self.bot_burst)
+        return self._bot_buckets[bot.self_id]
+
+    def _chat_bucket(self, bot, chat_id) -> TokenBucket:
+        if (bot.self_id, chat_id) not in self._chat_buckets:
+            self._chat_buckets[(bot.self_id, chat_id)] = TokenBucket(self.chat_rate, self.chat_burst)
+        return self._chat_buckets[(bot.self_id, chat_id)]
+
+    def _delay(self, bot, chat_id, now: float) -> float:
+        return max(self._usage(bot).parked_until - now,
+                   self._bot_bucket(bot).delay(now),
+                   self._chat_bucket(bot, chat_id).delay(now))
+
+    async def acquire(self, chat_id, prefer_bot_id: int = None):
+        while True:
+            bots = self.get_bots()
+            if not bots:
+                raise BotUnavailable("no telegram bot available")
+            now = time.monotonic()
+            # any bot in the chat can reply, the preferred one is only waited for while it's connected and not parked
+            preferred = [bot for bot in bots if prefer_bot_id and bot.self_id == str(prefer_bot_id)
+                         and self._usage(bot).parked_until <= now]
+            bots = preferred or bots
+            delays = {bot.self_id: self._delay(bot, chat_id, now) for bot in bots}
+            bot = min(bots, key=lambda bot: (delays[bot.self_id], self._usage(bot).sent))
+            delay = delays[bot.self_id]
+            if delay <= 0:
+                self._bot_bucket(bot).take(now)
+                self._chat_bucket(bot, chat_id).take(now)
+                return bot
+            await asyncio.sleep(delay)
+
+    def park(self, bot, seconds: float):
+        logger.warning(f"telegram bot {bot.self_id} is flood limited, parking it for {seconds}s")
+        usage = self._usage(bot)
+        usage.flood_waits += 1
+        usage.parked_until = max(usage.parked_until, time.monotonic() + seconds)
+
+    async def send(self, chat_id, send, prefer_bot_id: int = None):
+        # send(bot) is retried on another bot after a flood wait, prefer_bot_id included
+        for attempt in range(self.attempts):
+            bot = await self.acquire(chat_id, prefer_bot_id)
+            usage = self._usage(bot)
+            start = time.monotonic()
+            try:
+                result = await send(bot)
+            except Exception as e:
+                usage.errors += 1
+                if (seconds := retry_after(e)) is None or attempt == self.attempts - 1:
+                    raise
+                self.park(bot, seconds)
+                continue
+            finally:
+                usage.busy += time.monotonic() - start
+            usage.sent += 1
+            return bot, result
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            bot_id: {
+                "sent": usage.sent,
+                "errors": usage.errors,
+                "flood_waits": usage.flood_waits,
+                "parked": max(0, usage.parked_until - now),
+                "utilization": usage.busy / max(now - self.started, 1e-9),
+            }
+            for bot_id, usage in self.usage.items()
+        }
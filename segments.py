@@ -0,0 +1,194 @@
+import json
+import traceback
+
+from nonebot import logger
+import nonebot.adapters.onebot.v11 as v11
+
+# QQ face ids, only the ones QQ actually draws; 260 and up are the newer "super emoji"
+QQ_FACE_NAMES = {
+    0: "惊讶", 1: "撇嘴", 2: "色", 3: "发呆", 4: "得意", 5: "流泪", 6: "害羞", 7: "闭嘴", 8: "睡", 9: "大哭",
+    10: "尴尬", 11: "发怒", 12: "调皮", 13: "呲牙", 14: "微笑", 15: "难过", 16: "酷", 18: "抓狂", 19: "吐",
+    20: "偷笑", 21: "可爱", 22: "白眼", 23: "傲慢", 24: "饥饿", 25: "困", 26: "惊恐", 27: "流汗", 28: "憨笑",
+    29: "悠闲", 30: "奋斗", 31: "咒骂", 32: "疑问", 33: "嘘", 34: "晕", 35: "折磨", 36: "衰", 37: "骷髅",
+    38: "敲打", 39: "再见", 41: "发抖", 42: "爱情", 43: "跳跳", 46: "猪头", 49: "拥抱", 53: "蛋糕", 54: "闪电",
+    55: "炸弹", 56: "刀", 57: "足球", 59: "便便", 60: "咖啡", 61: "饭", 63: "玫瑰", 64: "凋谢", 66: "爱心",
+    67: "心碎", 69: "礼物", 74: "太阳", 75: "月亮", 76: "赞", 77: "踩", 78: "握手", 79: "胜利", 85: "飞吻",
+    86: "怄火", 89: "西瓜", 96: "冷汗", 97: "擦汗", 98: "抠鼻", 99: "鼓掌", 100: "糗大了", 101: "坏笑",
+    102: "左哼哼", 103: "右哼哼", 104: "哈欠", 105: "鄙视", 106: "委屈", 107: "快哭了", 108: "阴险", 109: "亲亲",
+    110: "吓", 111: "可怜", 112: "菜刀", 113: "啤酒", 114: "篮球", 115: "乒乓", 116: "示爱", 117: "瓢虫",
+    118: "抱拳", 119: "勾引", 120: "拳头", 121: "差劲", 122: "爱你", 123: "NO", 124: "OK", 125: "转圈",
+    126: "磕头", 127: "回头", 128: "跳绳", 129: "挥手", 130: "激动", 131: "街舞", 132: "献吻", 133: "左太极",
+    134: "右太极", 136: "双喜", 137: "鞭炮", 138: "灯笼", 139: "发财", 140: "K歌", 141: "购物", 142: "邮件",
+    143: "帅", 144: "喝彩", 145: "祈祷", 146: "爆筋", 147: "棒棒糖", 148: "喝奶", 149: "下面", 150: "香蕉",
+    151: "飞机", 152: "开车", 153: "高铁左车头", 154: "车厢", 155: "高铁右车头", 156: "多云", 157: "下雨",
+    158: "钞票", 159: "熊猫", 160: "灯泡", 161: "风车", 162: "闹钟", 163: "打伞", 164: "彩球", 165: "钻戒",
+    166: "沙发", 167: "纸巾", 168: "药", 169: "手枪", 170: "青蛙", 171: "茶", 172: "眨眼睛", 173: "泪奔",
+    174: "无奈", 175: "卖萌", 176: "小纠结", 177: "喷血", 178: "斜眼笑", 179: "doge", 180: "惊喜", 181: "骚扰",
+    182: "笑哭", 183: "我最美", 184: "河蟹", 185: "羊驼", 187: "幽灵", 188: "蛋", 190: "菊花", 192: "红包",
+    193: "大笑", 194: "不开心", 197: "冷漠", 198: "呃", 199: "好棒", 200: "拜托", 201: "点赞", 202: "无聊",
+    203: "托脸", 204: "吃", 205: "送花", 206: "害怕", 207: "花痴", 208: "小样儿", 210: "飙泪", 211: "我不看",
+    212: "托腮", 214: "啵啵", 215: "糊脸", 216: "拍头", 217: "扯一扯", 218: "舔一舔", 219: "蹭一蹭",
+    220: "拽炸天", 221: "顶呱呱", 222: "抱抱", 223: "暴击", 224: "开枪", 225: "撩一撩", 226: "拍桌", 227: "拍手",
+    228: "恭喜", 229: "干杯", 230: "嘲讽", 231: "哼", 232: "佛系", 233: "掐一掐", 234: "惊呆", 235: "颤抖",
+    236: "啃头", 237: "偷看", 238: "扇脸", 239: "原谅", 240: "喷脸", 241: "生日快乐",
+    262: "脑阔疼", 263: "沧桑", 264: "捂脸", 265: "辣眼睛", 266: "哦哟", 267: "头秃", 268: "问号脸",
+    269: "暗中观察", 270: "emm", 271: "吃瓜", 272: "呵呵哒", 273: "我酸了", 274: "太南了", 276: "辣椒酱",
+    277: "汪汪", 278: "汗", 279: "打脸", 280: "击掌", 281: "无眼笑", 282: "敬礼", 283: "狂笑", 284: "面无表情",
+    285: "摸鱼", 286: "魔鬼笑", 287: "哦", 288: "请", 289: "睁眼", 290: "敲开心", 292: "让我康康",
+    293: "摸锦鲤", 294: "期待", 295: "拿到红包", 297: "拜谢", 298: "元宝", 299: "牛啊", 300: "胖三斤",
+    301: "好闪", 302: "左拜年", 303: "右拜年", 305: "右亲亲", 306: "牛气冲天", 307: "喵喵", 311: "打call",
+    312: "变形", 314: "仔细分析", 315: "加油", 316: "崇拜", 317: "菜汪", 319: "比心", 320: "庆祝", 322: "拒绝",
+    323: "嫌弃", 324: "吃糖", 325: "惊吓", 326: "生气", 332: "举牌牌", 333: "烟花", 334: "虎虎生威",
+    336: "豹富", 337: "花朵脸", 338: "我想开了", 339: "舔屏", 341: "打招呼", 342: "酸Q", 343: "我方了",
+    344: "大怨种", 345: "红包多多", 346: "你真棒棒", 347: "大展宏兔", 348: "福萝卜", 349: "坚强", 350: "贴贴",
+    351: "敲敲", 352: "咦", 353: "拜托", 354: "尊嘟假嘟", 355: "耶", 356: "666", 357: "裂开",
+    392: "龙年快乐", 393: "新年中龙", 394: "新年大龙", 395: "略略略",
+}
+
+# faces with an obvious Unicode counterpart, which Telegram clients draw inline
+QQ_FACE_EMOJI = {
+    0: "😮", 2: "😍", 5: "😢", 8: "😴", 9: "😭", 11: "😡", 12: "😜", 13: "😁", 14: "🙂", 16: "😎", 26: "😱",
+    27: "😓", 33: "🤫", 34: "😵", 37: "💀", 46: "🐷", 49: "🤗", 53: "🎂", 54: "⚡", 55: "💣", 56: "🔪",
+    57: "⚽", 59: "💩", 60: "☕", 61: "🍚", 63: "🌹", 64: "🥀", 66: "❤️", 67: "💔", 69: "🎁", 74: "☀️",
+    75: "🌙", 76: "👍", 77: "👎", 78: "🤝", 79: "✌️", 85: "😘", 89: "🍉", 99: "👏", 104: "🥱", 109: "😚",
+    112: "🔪", 113: "🍺", 114: "🏀", 115: "🏓", 117: "🐞", 120: "✊", 124: "👌", 129: "👋", 137: "🧨",
+    138: "🏮", 144: "🎉", 145: "🙏", 147: "🍭", 148: "🍼", 150: "🍌", 151: "✈️", 152: "🚗", 154: "🚃",
+    156: "⛅", 157: "🌧️", 158: "💵", 159: "🐼", 160: "💡", 162: "⏰", 163: "☂️", 165: "💍", 166: "🛋️",
+    168: "💊", 169: "🔫", 170: "🐸", 171: "🍵", 172: "😉", 182: "😂", 185: "🦙", 187: "👻", 188: "🥚",
+    192: "🧧", 193: "😆", 194: "🙁", 204: "😋", 205: "💐", 206: "😨", 229: "🍻", 241: "🎂", 264: "🤦",
+    268: "🤨", 271: "🍉", 274: "😩", 277: "🐶", 278: "😅", 280: "🙌", 282: "🫡", 283: "🤣", 284: "😐",
+    285: "🐟", 286: "😈", 298: "💰", 307: "🐱", 319: "🫶", 320: "🥳", 333: "🎆", 352: "🤔", 355: "🥳",
+    356: "👍", 357: "😫",
+}
+
+# QQ's own emoji keyboard sends faces whose id is the Unicode code point
+UNICODE_FACE_MIN = 0x2000
+
+
+def face_table(emoji: bool = True) -> dict[str, str]:
+    # keyed by the id string as it arrives on the wire, so rendering a face is one dict lookup
+    return {str(id): (QQ_FACE_EMOJI.get(id) if emoji else None) or f"[{name}]" for id, name in QQ_FACE_NAMES.items()}
+
+
+def render_face(faces: dict[str, str], id) -> str:
+    id = str(id)
+    if text := faces.get(id):
+        return text
+    if id.isdigit() and UNICODE_FACE_MIN <= int(id) <= 0x10FFFF:
+        return chr(int(id))
+    return f"[face:{id}]"
+
+
+class Converters:
+    # segment converters by type. inline converters are plain functions returning the segment's text and run in
+    # place; media converters are coroutines that may download or upload and run concurrently
+    def __init__(self, fallback) -> None:
+        self.inline = {}
+        self.media = {}
+        self.fallback = fallback
+
+    def register_inline(self, *types: str):
+        def decorator(fn):
+            self.inline.update(dict.fromkeys(types, fn))
+            return fn
+        return decorator
+
+    def register_media(self, *types: str):
+        def decorator(fn):
+            self.media.update(dict.fromkeys(types, fn))
+            return fn
+        return decorator
+
+    def split(self, message) -> tuple[list, list]:
+        # renders the inline segments and leaves a None hole for every media segment, returned alongside it
+        parts = []
+        pending = []
+        for seg in message:
+            if convert := self.inline.get(seg.type):
+                try:
+                    parts.append(convert(seg))
+                except Exception as e:
+                    parts.append(f"\n[ERROR]\n{repr(e)}\non {repr(seg)}\n[\\ERROR]")
+                    traceback.print_exc()
+            elif convert := self.media.get(seg.type):
+                pending.append((len(parts), seg, convert))
+                parts.append(None)
+            else:
+                parts.append(self.fallback(seg))
+        return parts, pending
+
+
+class MessageBuilder:
+    # collects a OneBot message as a list, adjacent text merged into one segment, and builds it once:
+    # adding to a Message copies it every time
+    def __init__(self) -> None:
+        self.segments: list[v11.MessageSegment] = []
+        self.text: list[str] = []
+
+    def __bool__(self) -> bool:
+        return bool(self.segments) or any(self.text)
+
+    def append_text(self, text: str):
+        self.text.append(text)
+
+    def append(self, seg: v11.MessageSegment):
+        self._flush()
+        self.segments.append(seg)
+
+    def _flush(self):
+        if text := "".join(self.text):
+            self.segments.append(v11.MessageSegment.text(text))
+        self.text.clear()
+
+    def build(self) -> v11.Message:
+        self._flush()
+        return v11.Message(self.segments)
+
+
+def unsupported_qq_segment(seg: v11.MessageSegment) -> str:
+    logger.warning(f"unsupported message segment {seg!r}")
+    return f"[{seg.type}]"
+
+
+def qq_converters(face_emoji: bool = True) -> Converters:
+    # QQ segments to Telegram text; the media converters are registered by the relay, which owns the caches
+    faces = face_table(face_emoji)
+    converters = Converters(unsupported_qq_segment)
+
+    @converters.register_inline("text")
+    def text(seg):
+        return seg.data["text"]
+
+    @converters.register_inline("at")
+    def at(seg):
+        return f"@{seg.data['qq']} "
+
+    @converters.register_inline("face")
+    def face(seg):
+        return render_face(faces, seg.data["id"])
+
+    @converters.register_inline("mface")
+    def mface(seg):
+        return "[mface]"
+
+    @converters.register_inline("json")
+    def json_app(seg):
+        data = json.loads(seg.data["data"])
+        match data["app"]:
+            case "com.tencent.miniapp_01":
+                return f"[miniapp]{data['meta']['detail_1']['qqdocurl']}"
+            # case "com.tencent.structmsg":
+            #     return f"[structmsg]{data['meta']['news']['jumpUrl']}"
+            case _:
+                logger.warning(f"unsupported json app {data!r}")
+                return f"[json]\n{json.dumps(data, ensure_ascii=False, indent=2)}"
+
+    return converters
+
+
+def tg_converters() -> Converters:
+    # Telegram segments to OneBot segments; every text-like entity (bold, url, mention...) keeps just its text
+    def fallback(seg):
+        return seg.data.get("text", "") if seg.is_text() else seg.type
+
+    return Converters(fallback)
@@ -0,0 +1,230 @@
+from dataclasses import dataclass
+
+# enough to reach the dimensions of everything but an mp4 with its index at the end or a jpeg behind a huge exif
+SNIFF_SIZE = 64 * 1024
+
+IMAGE_FORMATS = {"gif", "png", "apng", "jpeg", "webp", "heic", "avif"}
+VIDEO_FORMATS = {"mp4", "webm", "matroska"}
+AUDIO_FORMATS = {"ogg", "amr", "amr-wb", "silk"}
+EXTENSIONS = {"jpeg": "jpg", "apng": "png", "amr-wb": "amr", "matroska": "mkv"}
+
+JPEG_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+HEIF_BRANDS = {b"heic", b"heix", b"hevc", b"mif1", b"msf1"}
+AVIF_BRANDS = {b"avif", b"avis"}
+
+
+@dataclass
+class MediaInfo:
+    format: str
+    width: int = None
+    height: int = None
+    animated: bool = False
+
+    @property
+    def kind(self) -> str:
+        if self.format in IMAGE_FORMATS:
+            return "image"
+        if self.format in VIDEO_FORMATS:
+            return "video"
+        if self.format in AUDIO_FORMATS:
+            return "audio"
+        return None
+
+    @property
+    def extension(self) -> str:
+        return EXTENSIONS.get(self.format, self.format)
+
+
+def _u16be(data: bytes, i: int) -> int:
+    return int.from_bytes(data[i:i + 2], "big")
+
+
+def _u32be(data: bytes, i: int) -> int:
+    return int.from_bytes(data[i:i + 4], "big")
+
+
+def _u16le(data: bytes, i: int) -> int:
+    return int.from_bytes(data[i:i + 2], "little")
+
+
+def _gif(head: bytes) -> MediaInfo:
+    return MediaInfo("gif", _u16le(head, 6), _u16le(head, 8))
+
+
+def _png(head: bytes) -> MediaInfo:
+    info = MediaInfo("png", _u32be(head, 16), _u32be(head, 20))
+    # an animated png announces itself with an acTL chunk before the first IDAT
+    i = 8
+    while i + 8 <= len(head):
+        chunk = head[i + 4:i + 8]
+        if chunk == b"acTL":
+            info.format = "apng"
+            info.animated = True
+            break
+        if chunk == b"IDAT":
+            break
+        i += 12 + _u32be(head, i)
+    return info
+
+
+def _jpeg(head: bytes) -> MediaInfo:
+    info = MediaInfo("jpeg")
+    i = 2
+    while i + 9 <= len(head):
+        if head[i] != 0xFF:
+            break
+        marker = head[i + 1]
+        if marker == 0xFF:
+            i += 1
+        elif marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:
+            i += 2
+        elif marker in JPEG_SOF:
+            info.height = _u16be(head, i + 5)
+            info.width = _u16be(head, i + 7)
+            break
+        else:
+            i += 2 + _u16be(head, i + 2)
+    return info
+
+
+def _webp(head: bytes) -> MediaInfo:
+    info = MediaInfo("webp")
+    chunk = head[12:16]
+    if chunk == b"VP8X" and len(head) >= 30:
+        info.animated = bool(head[20] & 0x02)
+        info.width = 1 + int.from_bytes(head[24:27], "little")
+        info.height = 1 + int.from_bytes(head[27:30], "little")
+    elif chunk == b"VP8L" and len(head) >= 25:
+        bits = int.from_bytes(head[21:25], "little")
+        info.width = (bits & 0x3FFF) + 1
+        info.height = ((bits >> 14) & 0x3FFF) + 1
+    elif chunk == b"VP8 " and len(head) >= 30:
+        info.width = _u16le(head, 26) & 0x3FFF
+        info.height = _u16le(head, 28) & 0x3FFF
+    return info
+
+
+def _mp4_boxes(data: bytes, start: int, end: int):
+    i = start
+    while i + 8 <= end:
+        size = _u32be(data, i)
+        header = 8
+        if size == 1:
+            size = int.from_bytes(data[i + 8:i + 16], "big")
+            header = 16
+        elif size == 0:
+            size = end - i
+        if size < header:
+            return
+        yield data[i + 4:i + 8], i + header, min(i + size, end)
+        i += size
+
+
+def _mp4(head: bytes) -> MediaInfo:
+    brand = head[8:12]
+    info = MediaInfo("heic" if brand in HEIF_BRANDS else "avif" if brand in AVIF_BRANDS else "mp4")
+    if info.format != "mp4":
+        return info
+    # the first track with a picture, found only when moov comes before the media data
+    for box, start, end in _mp4_boxes(head, 0, len(head)):
+        if box != b"moov":
+            continue
+        for box, start, end in _mp4_boxes(head, start, end):
+            if box != b"trak":
+                continue
+            for box, start, end in _mp4_boxes(head, start, end):
+                if box != b"tkhd":
+                    continue
+                offset = start + (88 if head[start] == 1 else 76)
+                if offset + 8 <= end and (width := _u32be(head, offset) >> 16):
+                    info.width = width
+                    info.height = _u32be(head, offset + 4) >> 16
+                    return info
+    return info
+
+
+def _ebml_vint(data: bytes, i: int, keep_marker: bool) -> tuple[int, int]:
+    length = 9 - data[i].bit_length() if data[i] else 9
+    if length > 8 or i + length > len(data):
+        raise ValueError("bad ebml")
+    value = int.from_bytes(data[i:i + length], "big")
+    if not keep_marker:
+        value &= (1 << (7 * length)) - 1
+        if value == (1 << (7 * length)) - 1:
+            value = None  # unknown size, runs to the end of the parent
+    return value, i + length
+
+
+def _ebml_elements(data: bytes, start: int, end: int):
+    i = start
+    while i < end:
+        try:
+            element, i = _ebml_vint(data, i, True)
+            size, i = _ebml_vint(data, i, False)
+        except (ValueError, IndexError):
+            return
+        element_end = end if size is None else min(i + size, end)
+        yield element, i, element_end
+        i = element_end
+
+
+def _matroska(head: bytes) -> MediaInfo:
+    info = MediaInfo("matroska")
+    for element, start, end in _ebml_elements(head, 0, len(head)):
+        if element == 0x1A45DFA3:
+            for child, child_start, child_end in _ebml_elements(head, start, end):
+                if child == 0x4282 and head[child_start:child_end] == b"webm":
+                    info.format = "webm"
+        elif element == 0x18538067:
+            for child, child_start, child_end in _ebml_elements(head, start, end):
+                if child == 0x1F43B675:
+                    break  # clusters are the media, tracks come before them
+                if child == 0x1654AE6B:
+                    _matroska_tracks(head, child_start, child_end, info)
+                    return info
+    return info
+
+
+def _matroska_tracks(head: bytes, start: int, end: int, info: MediaInfo):
+    for track, track_start, track_end in _ebml_elements(head, start, end):
+        if track != 0xAE:
+            continue
+        for element, video_start, video_end in _ebml_elements(head, track_start, track_end):
+            if element != 0xE0:
+                continue
+            for dimension, value_start, value_end in _ebml_elements(head, video_start, video_end):
+                if dimension == 0xB0:
+                    info.width = int.from_bytes(head[value_start:value_end], "big")
+                elif dimension == 0xBA:
+                    info.height = int.from_bytes(head[value_start:value_end], "big")
+            if info.width:
+                return
+
+
+def sniff(head: bytes) -> MediaInfo:
+    # tells the container from its first bytes; None when it isn't one we know, dimensions None when out of reach
+    try:
+        if head[:6] in (b"GIF87a", b"GIF89a"):
+            return _gif(head)
+        if head[:8] == b"\x89PNG\r\n\x1a\n":
+            return _png(head)
+        if head[:3] == b"\xff\xd8\xff":
+            return _jpeg(head)
+        if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+            return _webp(head)
+        if head[4:8] == b"ftyp":
+            return _mp4(head)
+        if head[:4] == b"\x1a\x45\xdf\xa3":
+            return _matroska(head)
+        if head[:4] == b"OggS":
+            return MediaInfo("ogg")
+        if head[:9] == b"#!AMR-WB\n":
+            return MediaInfo("amr-wb")
+        if head[:6] == b"#!AMR\n":
+            return MediaInfo("amr")
+        # QQ prefixes its silk with a stray 0x02
+        if head[:9] == b"#!SILK_V3" or head[:10] == b"\x02#!SILK_V3":
+            return MediaInfo("silk")
+    except IndexError:
+        pass
+    return None
@@ -0,0 +1,102 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from nonebot import logger
+
+# these run in the worker processes, which import pyav, imageio and numpy only once a job needs them
+
+
+def warm_up():
+    import animation  # noqa: F401
+    import imageio.v3  # noqa: F401
+    import voice  # noqa: F401
+
+
+def probe_codec(data) -> str:
+    import imageio.v3 as iio
+    return iio.immeta(data, plugin="pyav")['codec']
+
+
+def to_gif(data: bytes, max_dimension: int = 320, fps: float = 15, max_frames: int = 100) -> bytes:
+    import animation
+    return animation.encode_gif(data, max_dimension, fps, max_frames)
+
+
+def to_ogg_opus(source) -> bytes:
+    import voice
+    return voice.to_ogg_opus(source)
+
+
+def to_qq_voice(source, format: str = "silk") -> bytes:
+    import voice
+    return voice.to_qq(source, format)
+
+
+class TranscodeTimeout(Exception):
+    pass
+
+
+class Transcoder:
+    def __init__(self, workers: int = 2, queue_size: int = 16, timeout: float = 60) -> None:
+        self.workers = workers
+        self.timeout = timeout
+        self.executor: ProcessPoolExecutor = None
+        self.pending = 0
+        self._slots = asyncio.Semaphore(queue_size)
+        self._running = asyncio.Semaphore(workers)
+
+    def start(self):
+        if not self.executor:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+
+    async def warm_up(self):
+        # started in the background, so the first sticker or voice note doesn't pay for the imports
+        await asyncio.gather(*(self.run(warm_up) for _ in range(self.workers)), return_exceptions=True)
+
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def _restart(self):
+        # a running job can't be cancelled, so kill the workers and start a fresh pool
+        executor = self.executor
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        for process in list((executor._processes or {}).values()):
+            process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    async def run(self, fn, *args):
+        self.start()
+        self.pending += 1
+        try:
+            # waiting here is the backpressure: at most queue_size jobs are queued or running
+            async with self._slots:
+                # and a job is only submitted once a worker is free, so the timeout counts its running time alone
+                async with self._running:
+                    return await self._run(fn, *args)
+        finally:
+            self.pending -= 1
+
+    async def _run(self, fn, *args):
+        while True:
+            executor = self.executor
+            future = executor.submit(fn, *args)
+            try:
+                return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+            except BrokenProcessPool:
+                if executor is self.executor:
+                    logger.error(f"a worker died running {fn.__name__}, restarting workers")
+                    self._restart()
+                    raise
+                # killed by the restart for another job's hang, not our fault: run again on the new pool
+            except asyncio.TimeoutError:
+                # one restart per hung pool, however many of its jobs notice
+                if executor is self.executor:
+                    logger.error(f"transcoding {fn.__name__} timed out after {self.timeout}s, restarting workers")
+                    self._restart()
+                raise TranscodeTimeout(f"{fn.__name__} timed out after {self.timeout}s")
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
@@ -1,5 +1,12 @@
+import asyncio
+from collections import OrderedDict
 import hashlib
+import io
+import mmap
+import os
 import ssl
+import tempfile
+import time
 
 import aiohttp
 
@@ -19,275 +26,185 @@ def identicon(n: int):
     return icon
 
 
-async def download_file(url):
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.2.1 Safari/605.1.15"
-    }
+_loaded_at = time.monotonic()
+
+
+def process_uptime() -> float:
+    # seconds since the process started, imports included; since this module loaded where /proc isn't there
+    try:
+        with open("/proc/self/stat") as f:
+            # the command name may hold spaces, so count fields from its closing parenthesis
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            return float(f.read().split()[0]) - start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return time.monotonic() - _loaded_at
+
+
+
+def utf16_len(text: str) -> int:
+    # Telegram measures text in UTF-16 code units, an emoji outside the BMP is two
+    return len(text.encode("utf-16-le")) // 2
+
+
+class LRUCache:
+    def __init__(self, max_size: int, sizeof=lambda value: 1):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self._items = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        if key not in self._items:
+            return default
+        self._items.move_to_end(key)
+        return self._items[key]
+
+    def put(self, key, value):
+        self.pop(key)
+        self._items[key] = value
+        self.size += self.sizeof(value)
+        while self.size > self.max_size and self._items:
+            _, evicted = self._items.popitem(last=False)
+            self.size -= self.sizeof(evicted)
+
+    def pop(self, key, default=None):
+        if key not in self._items:
+            return default
+        value = self._items.pop(key)
+        self.size -= self.sizeof(value)
+        return value
+
+
+class SingleFlight:
+    # concurrent calls with the same key share one in-flight call, different keys never wait on each other
+    def __init__(self) -> None:
+        self._calls: dict[object, asyncio.Task] = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    async def do(self, key, fn, *args):
+        task = self._calls.get(key)
+        if task is None:
+            task = self._calls[key] = asyncio.ensure_future(fn(*args))
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        # a cancelled caller must not cancel the call the other callers are waiting on
+        return await asyncio.shield(task)
+
+
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.2.1 Safari/605.1.15"
+}
+CHUNK_SIZE = 64 * 1024
+_session: aiohttp.ClientSession = None
+
+
+class FileTooLarge(Exception):
+    pass
+
+
+class BotUnavailable(LookupError):
+    pass
+
+
+def _ssl_context():
     # ssl_context = ssl.SSLContext(ssl.PROTOCOL_SSLv2)
     ssl_context = ssl.create_default_context()
     ssl_context.options = ssl.PROTOCOL_TLSv1_2
     ssl_context.set_ciphers("AES128-GCM-SHA256")
-    connector = aiohttp.TCPConnector(ssl_context=ssl_context)
-    async with aiohttp.ClientSession(connector=connector) as session:
-        async with session.get(url, headers=headers) as resp:
-            return await resp.read()
-
-
-qq_emoji_text_list = {
-    0: "惊讶",
-    1: "撇嘴",
-    2: "色",
-    3: "发呆",
-    4: "得意",
-    5: "流泪",
-    6: "害羞",
-    7: "闭嘴",
-    8: "睡",
-    9: "大哭",
-    10: "尴尬",
-    11: "发怒",
-    12: "调皮",
-    13: "呲牙",
-    14: "微笑",
-    15: "难过",
-    16: "酷",
-    17: "Empty",
-    18: "抓狂",
-    19: "吐",
-    20: "偷笑",
-    21: "可爱",
-    22: "白眼",
-    23: "傲慢",
-    24: "饥饿",
-    25: "困",
-    26: "惊恐",
-    27: "流汗",
-    28: "憨笑",
-    29: "悠闲",
-    30: "奋斗",
-    31: "咒骂",
-    32: "疑问",
-    33: "嘘",
-    34: "晕",
-    35: "折磨",
-    36: "衰",
-    37: "骷髅",
-    38: "敲打",
-    39: "再见",
-    40: "Empty",
-    41: "发抖",
-    42: "爱情",
-    43: "跳跳",
-    44: "Empty",
-    45: "Empty",
-    46: "猪头",
-    47: "Empty",
-    48: "Empty",
-    49: "拥抱",
-    50: "Empty",
-    51: "Empty",
-    52: "Empty",
-    53: "蛋糕",
-    54: "闪电",
-    55: "炸弹",
-    56: "刀",
-    57: "足球",
-    58: "Empty",
-    59: "便便",
-    60: "咖啡",
-    61: "饭",
-    62: "Empty",
-    63: "玫瑰",
-    64: "凋谢",
-    65: "Empty",
-    66: "爱心",
-    67: "心碎",
-    68: "Empty",
-    69: "礼物",
-    70: "Empty",
-    71: "Empty",
-    72: "Empty",
-    73: "Empty",
-    74: "太阳",
-    75: "月亮",
-    76: "赞",
-    77: "踩",
-    78: "握手",
-    79: "胜利",
-    80: "Empty",
-    81: "Empty",
-    82: "Empty",
-    83: "Empty",
-    84: "Empty",
-    85: "飞吻",
-    86: "怄火",
-    87: "Empty",
-    88: "Empty",
-    89: "西瓜",
-    90: "Empty",
-    91: "Empty",
-    92: "Empty",
-    93: "Empty",
-    94: "Empty",
-    95: "Empty",
-    96: "冷汗",
-    97: "擦汗",
-    98: "抠鼻",
-    99: "鼓掌",
-    100: "糗大了",
-    101: "坏笑",
-    102: "左哼哼",
-    103: "右哼哼",
-    104: "哈欠",
-    105: "鄙视",
-    106: "委屈",
-    107: "快哭了",
-    108: "阴险",
-    109: "亲亲",
-    110: "吓",
-    111: "可怜",
-    112: "菜刀",
-    113: "啤酒",
-    114: "篮球",
-    115: "乒乓",
-    116: "示爱",
-    117: "瓢虫",
-    118: "抱拳",
-    119: "勾引",
-    120: "拳头",
-    121: "差劲",
-    122: "爱你",
-    123: "NO",
-    124: "OK",
-    125: "转圈",
-    126: "磕头",
-    127: "回头",
-    128: "跳绳",
-    129: "挥手",
-    130: "激动",
-    131: "街舞",
-    132: "献吻",
-    133: "左太极",
-    134: "右太极",
-    135: "Empty",
-    136: "双喜",
-    137: "鞭炮",
-    138: "灯笼",
-    139: "发财",
-    140: "K歌",
-    141: "购物",
-    142: "邮件",
-    143: "帅",
-    144: "喝彩",
-    145: "祈祷",
-    146: "爆筋",
-    147: "棒棒糖",
-    148: "喝奶",
-    149: "下面",
-    150: "香蕉",
-    151: "飞机",
-    152: "开车",
-    153: "高铁左车头",
-    154: "车厢",
-    155: "高铁右车头",
-    156: "多云",
-    157: "下雨",
-    158: "钞票",
-    159: "熊猫",
-    160: "灯泡",
-    161: "风车",
-    162: "闹钟",
-    163: "打伞",
-    164: "彩球",
-    165: "钻戒",
-    166: "沙发",
-    167: "纸巾",
-    168: "药",
-    169: "手枪",
-    170: "青蛙",
-    171: "茶",
-    172: "眨眼睛",
-    173: "泪奔",
-    174: "无奈",
-    175: "卖萌",
-    176: "小纠结",
-    177: "喷血",
-    178: "斜眼笑",
-    179: "doge",
-    180: "惊喜",
-    181: "骚扰",
-    182: "笑哭",
-    183: "我最美",
-    184: "河蟹",
-    185: "羊驼",
-    186: "Empty",
-    187: "幽灵",
-    188: "蛋",
-    189: "Empty",
-    190: "菊花",
-    191: "Empty",
-    192: "红包",
-    193: "大笑",
-    194: "不开心",
-    195: "Empty",
-    196: "Empty",
-    197: "冷漠",
-    198: "呃",
-    199: "好棒",
-    200: "拜托",
-    201: "点赞",
-    202: "无聊",
-    203: "托脸",
-    204: "吃",
-    205: "送花",
-    206: "害怕",
-    207: "花痴",
-    208: "小样儿",
-    209: "Empty",
-    210: "飙泪",
-    211: "我不看",
-    212: "托腮",
-    213: "Empty",
-    214: "啵啵",
-    215: "糊脸",
-    216: "拍头",
-    217: "扯一扯",
-    218: "舔一舔",
-    219: "蹭一蹭",
-    220: "拽炸天",
-    221: "顶呱呱",
-    222: "抱抱",
-    223: "暴击",
-    224: "开枪",
-    225: "撩一撩",
-    226: "拍桌",
-    227: "拍手",
-    228: "恭喜",
-    229: "干杯",
-    230: "嘲讽",
-    231: "哼",
-    232: "佛系",
-    233: "掐一掐",
-    234: "惊呆",
-    235: "颤抖",
-    236: "啃头",
-    237: "偷看",
-    238: "扇脸",
-    239: "原谅",
-    240: "喷脸",
-    241: "生日快乐",
-    242: "Empty",
-    243: "Empty",
-    244: "Empty",
-    245: "Empty",
-    246: "Empty",
-    247: "Empty",
-    248: "Empty",
-    249: "Empty",
-    250: "Empty",
-    251: "Empty",
-    252: "Empty",
-    253: "Empty",
-    254: "Empty",
-    255: "Empty",
-}
+    return ssl_context
+
+
+async def open_http_client(limit: int = 100, limit_per_host: int = 8, keepalive_timeout: float = 30,
+                           dns_cache_ttl: int = 300, timeout: float = 300, connect_timeout: float = 10):
+    global _session
+    if _session and not _session.closed:
+        return _session
+    connector = aiohttp.TCPConnector(ssl=_ssl_context(), limit=limit, limit_per_host=limit_per_host,
+                                     keepalive_timeout=keepalive_timeout, use_dns_cache=True, ttl_dns_cache=dns_cache_ttl)
+    _session = aiohttp.ClientSession(connector=connector, headers=HEADERS,
+                                     timeout=aiohttp.ClientTimeout(total=timeout, sock_connect=connect_timeout))
+    return _session
+
+
+async def close_http_client():
+    global _session
+    if _session:
+        await _session.close()
+        _session = None
+
+
+async def download_to_file(url, max_size: int = None, spool_threshold: int = 4 * 1024 * 1024):
+    session = await open_http_client()
+    async with session.get(url) as resp:
+        if max_size and resp.content_length and resp.content_length > max_size:
+            raise FileTooLarge(f"{url} is {resp.content_length} bytes, limit is {max_size}")
+        # tempfile.SpooledTemporaryFile reports mode "w+b" while in memory, which makes pyav open it for writing
+        f = io.BytesIO()
+        try:
+            size = 0
+            async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                size += len(chunk)
+                if max_size and size > max_size:
+                    raise FileTooLarge(f"{url} exceeds {max_size} bytes")
+                f.write(chunk)
+                if isinstance(f, io.BytesIO) and size > spool_threshold:
+                    spooled = tempfile.TemporaryFile()
+                    spooled.write(f.getvalue())
+                    f = spooled
+        except BaseException:
+            f.close()
+            raise
+        f.seek(0)
+        return f
+
+
+def _file_sha256(f) -> str:
+    f.seek(0)
+    try:
+        # hash straight from the page cache, a big file is never copied into our memory
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return hashlib.sha256(mapped).hexdigest()
+    except (OSError, ValueError):
+        # in-memory files have no descriptor and empty files can't be mapped
+        pass
+    sha256 = hashlib.sha256()
+    while chunk := f.read(CHUNK_SIZE):
+        sha256.update(chunk)
+    f.seek(0)
+    return sha256.hexdigest()
+
+
+async def file_sha256(f) -> str:
+    return await asyncio.to_thread(_file_sha256, f)
+
+
+def _open_local_file(path, max_size: int = None):
+    f = open(path, "rb")
+    size = os.fstat(f.fileno()).st_size
+    if max_size and size > max_size:
+        f.close()
+        raise FileTooLarge(f"{path} is {size} bytes, limit is {max_size}")
+    return f
+
+
+async def open_local_file(path, max_size: int = None):
+    # the OneBot implementation's files may sit on a slow or network disk, keep even the open off the loop
+    return await asyncio.to_thread(_open_local_file, path, max_size)
+
+
+def upload_view(f):
+    # aiohttp closes a real file once it is uploaded, so give it a second file object over the same
+    # descriptor: the upload still streams from disk and the original survives for a retry
+    f.seek(0)
+    if isinstance(f, io.BytesIO):
+        return f
+    return open(f.fileno(), "rb", closefd=False)
+
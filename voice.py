@@ -0,0 +1,104 @@
+import io
+import tempfile
+
+import av
+import numpy as np
+
+from sniff import SNIFF_SIZE, sniff
+
+SILK_RATE = 24000
+PCM_CHUNK = 4800  # samples per frame handed to the encoder, 0.2s at SILK_RATE
+
+
+def _silk_frames(source):
+    # silk isn't in FFmpeg: pysilk decodes to PCM in a temporary file, which is then read back a chunk at a time
+    import pysilk
+    with tempfile.TemporaryFile() as pcm:
+        if isinstance(source, (bytes, bytearray)):
+            pysilk.decode(io.BytesIO(source), pcm, SILK_RATE)
+        else:
+            with open(source, "rb") as f:
+                pysilk.decode(f, pcm, SILK_RATE)
+        pcm.seek(0)
+        while chunk := pcm.read(PCM_CHUNK * 2):
+            samples = np.frombuffer(chunk[:len(chunk) // 2 * 2], dtype=np.int16).reshape(1, -1)
+            frame = av.AudioFrame.from_ndarray(samples, format="s16", layout="mono")
+            frame.sample_rate = SILK_RATE
+            yield frame
+
+
+def _av_frames(source):
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    with av.open(source) as container:
+        yield from container.decode(audio=0)
+
+
+def _head(source) -> bytes:
+    if isinstance(source, (bytes, bytearray)):
+        return bytes(source[:SNIFF_SIZE])
+    with open(source, "rb") as f:
+        return f.read(SNIFF_SIZE)
+
+
+def decode_frames(source):
+    # yields the decoded audio one frame at a time, never the whole clip
+    info = sniff(_head(source))
+    if info and info.format == "silk":
+        return _silk_frames(source)
+    return _av_frames(source)
+
+
+def _encode(frames, container_format: str, codec: str, rate: int, bit_rate: int) -> bytes:
+    output = io.BytesIO()
+    with av.open(output, "w", format=container_format) as container:
+        stream = container.add_stream(codec, rate=rate, layout="mono")
+        stream.bit_rate = bit_rate
+        resampler = av.AudioResampler(format=stream.format.name, layout="mono", rate=rate)
+        for frame in frames:
+            frame.pts = None
+            for resampled in resampler.resample(frame):
+                container.mux(stream.encode(resampled))
+        for resampled in resampler.resample(None):
+            container.mux(stream.encode(resampled))
+        container.mux(stream.encode(None))
+    return output.getvalue()
+
+
+def _pcm(frames, rate: int):
+    # raw mono s16, spooled to disk past a few seconds of audio
+    pcm = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    resampler = av.AudioResampler(format="s16", layout="mono", rate=rate)
+    for frame in frames:
+        frame.pts = None
+        for resampled in resampler.resample(frame):
+            pcm.write(resampled.to_ndarray().tobytes())
+    for resampled in resampler.resample(None):
+        pcm.write(resampled.to_ndarray().tobytes())
+    pcm.seek(0)
+    return pcm
+
+
+def to_ogg_opus(source, bit_rate: int = 32000) -> bytes:
+    # what Telegram plays as a voice note
+    return _encode(decode_frames(source), "ogg", "libopus", 48000, bit_rate)
+
+
+def to_silk(source, bit_rate: int = 24000) -> bytes:
+    import pysilk
+    output = io.BytesIO()
+    with _pcm(decode_frames(source), SILK_RATE) as pcm:
+        pysilk.encode(pcm, output, SILK_RATE, bit_rate, tencent=True)
+    return output.getvalue()
+
+
+def to_amr(source) -> bytes:
+    # the other format QQ plays natively, for when pysilk isn't installed
+    return _encode(decode_frames(source), "amr", "libopencore_amrnb", 8000, 12200)
+
+
+QQ_ENCODERS = {"silk": to_silk, "amr": to_amr}
+
+
+def to_qq(source, format: str = "silk") -> bytes:
+    return QQ_ENCODERS[format](source)